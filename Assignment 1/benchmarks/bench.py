@@ -0,0 +1,371 @@
+"""
+Benchmarks for mysh. Run from anywhere with: python3 benchmarks/bench.py [--json] [benchmark ...]
+
+With --json the results are printed as one JSON object of
+{benchmark: {metric: value}}, so runs can be stored and compared.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+SHELL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SHELL_DIR)
+
+import cmdhash
+import mysh
+from launcher import spawn, fork_exec
+from variables import child_environ, mark_environ_dirty, set_variable
+from parsing import tokenize, parse_line, expand_stage, expand_variables, split_by_pipe_op, clear_glob_cache
+
+
+def _per_call(func, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - start) / runs
+
+
+def _time_launches(launch, cmd_path, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        pid = launch(['true'], cmd_path)
+        os.waitpid(pid, 0)
+    return (time.perf_counter() - start) / runs
+
+
+def bench_parse(runs=2000):
+    """
+    Lexing and expansion cost per line for a long synthetic pipeline.
+    """
+    os.environ['BENCH_VAR'] = 'value'
+    mark_environ_dirty()
+    stage = 'grep -e "quoted ${BENCH_VAR} text" --flag=${BENCH_VAR} \'single quoted\' plain words here'
+    line = ' | '.join([stage] * 8)
+    args_line = 'echo ' + ' '.join(['$BENCH_VAR ${BENCH_VAR:-none} ${#BENCH_VAR} --opt=${BENCH_VAR}.$?'] * 100)
+    return {
+        "line_bytes": len(line),
+        "tokenize_us": _per_call(lambda: tokenize(line), runs) * 1e6,
+        "parse_line_cached_us": _per_call(lambda: parse_line(line), runs) * 1e6,
+        "split_by_pipe_op_us": _per_call(lambda: split_by_pipe_op(line), runs) * 1e6,
+        "expand_variables_us": _per_call(lambda: expand_variables(stage), runs) * 1e6,
+        "expand_stages_us": _per_call(lambda: [expand_stage(s) for s in parse_line(line).stages], runs) * 1e6,
+        "parse_command_expanded_us": _per_call(lambda: mysh.parse_command_expanded(stage), runs) * 1e6,
+        "expand_400_args_us": _per_call(lambda: mysh.parse_command_expanded(args_line), runs) * 1e6,
+    }
+
+
+def bench_lookup(runs=2000, path_dirs=500):
+    """
+    Command lookup against a PATH of many empty directories, with and without the hash.
+    """
+    saved_path = os.environ.get('PATH', '')
+    with tempfile.TemporaryDirectory() as tmp:
+        dirs = []
+        for i in range(path_dirs):
+            path_dir = os.path.join(tmp, f"d{i}")
+            os.mkdir(path_dir)
+            dirs.append(path_dir)
+        os.environ['PATH'] = os.pathsep.join(dirs + [saved_path])
+        try:
+            cold = _per_call(lambda: (cmdhash.hash_clear(), cmdhash.search_cmd_path('true')), runs // 10)
+            cmdhash.search_cmd_path('true')
+            hashed = _per_call(lambda: cmdhash.search_cmd_path('true'), runs)
+        finally:
+            os.environ['PATH'] = saved_path
+            cmdhash.hash_clear()
+    return {"path_dirs": path_dirs, "scan_us": cold * 1e6, "hashed_us": hashed * 1e6}
+
+
+def bench_spawn(runs=300):
+    """
+    Per-command launch latency of posix_spawn against fork+exec, at the
+    shell's normal size and with extra resident memory to copy on fork.
+    """
+    cmd_path = shutil.which('true')
+    results = {}
+    ballast = None
+    for rss_mb in (0, 256):
+        if rss_mb:
+            ballast = bytearray(rss_mb * 1024 * 1024)
+            ballast[::4096] = b'x' * len(ballast[::4096])
+        results[f"posix_spawn_us_rss+{rss_mb}MB"] = _time_launches(spawn, cmd_path, runs) * 1e6
+        results[f"fork_exec_us_rss+{rss_mb}MB"] = _time_launches(fork_exec, cmd_path, runs) * 1e6
+    del ballast
+    return results
+
+
+def bench_glob(files=200000):
+    """
+    Expanding a pattern over a directory of files entries, with and without its
+    listing cached, and commands over all of them split into ARG_MAX sized batches.
+    """
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(files):
+            os.close(os.open(os.path.join(tmp, f"file_{i:07d}.txt"), os.O_CREAT | os.O_WRONLY))
+        os.chdir(tmp)
+        try:
+            stage = parse_line('rm -f *.txt').stages[0]
+            start = time.perf_counter()
+            results["args"] = len(expand_stage(stage)) - 2
+            results["expand_cold_ms"] = (time.perf_counter() - start) * 1e3
+            results["expand_cached_ms"] = _per_call(lambda: expand_stage(stage), 5) * 1e3
+            clear_glob_cache()
+            for jobs in ("1", "4"):
+                set_variable('MYSH_ARG_BATCH', jobs)
+                results[f"true_batch{jobs}_ms"] = _per_call(lambda: mysh.run_line('true *.txt'), 3) * 1e3
+            start = time.perf_counter()
+            mysh.run_line('rm -f *.txt')
+            results["rm_all_ms"] = (time.perf_counter() - start) * 1e3
+        finally:
+            os.chdir(cwd)
+            set_variable('MYSH_ARG_BATCH', '')
+    return results
+
+
+def bench_environ(runs=300, extra_vars=1000):
+    """
+    posix_spawn latency passing os.environ, which is re-encoded on every call,
+    against the cached encoded environment, with extra_vars more variables set.
+    """
+    cmd_path = shutil.which('true')
+    saved_environ = dict(os.environ)
+    results = {}
+    try:
+        for count in (0, extra_vars):
+            for i in range(count):
+                os.environ[f"BENCH_ENV_{i}"] = 'x' * 64
+            mark_environ_dirty()
+            for name, env in (("os_environ", lambda: os.environ), ("cached", child_environ)):
+                start = time.perf_counter()
+                for _ in range(runs):
+                    os.waitpid(os.posix_spawn(cmd_path, ['true'], env()), 0)
+                results[f"{name}_us_vars+{count}"] = (time.perf_counter() - start) / runs * 1e6
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        mark_environ_dirty()
+    return results
+
+
+def bench_pipeline(megabytes=256):
+    """
+    Throughput of head -c N /dev/zero | cat | ... into /dev/null for several pipeline
+    lengths, with default pipe buffers and with MYSH_PIPE_SIZE=1M.
+    """
+    results = {}
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        for size in ('', '1M'):
+            set_variable('MYSH_PIPE_SIZE', size)
+            suffix = f"_pipe{size}" if size else ""
+            for stages in (1, 2, 4, 8):
+                line = f"head -c {megabytes}M /dev/zero" + " | cat" * (stages - 1)
+                start = time.perf_counter()
+                mysh.run_pipeline(parse_line(line), devnull)
+                results[f"stages_{stages}{suffix}_MBps"] = megabytes / (time.perf_counter() - start)
+    finally:
+        set_variable('MYSH_PIPE_SIZE', '')
+        os.close(devnull)
+    return results
+
+
+def bench_tee(megabytes=256):
+    """
+    head -c N /dev/zero | tee file | cat with the tee builtin against /usr/bin/tee.
+    """
+    results = {}
+    tee_path = shutil.which('tee')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            target = os.path.join(tmp, 'out')
+            for name, tee in (("builtin", "tee"), ("external", tee_path)):
+                line = f"head -c {megabytes}M /dev/zero | {tee} {target} | cat"
+                start = time.perf_counter()
+                mysh.run_pipeline(parse_line(line), devnull)
+                results[f"{name}_MBps"] = megabytes / (time.perf_counter() - start)
+    finally:
+        os.close(devnull)
+    return results
+
+
+def bench_redirect(megabytes=256):
+    """
+    Reading a large file with wc -l < file against cat file | wc -l.
+    """
+    results = {}
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    with tempfile.NamedTemporaryFile() as data:
+        data.truncate(megabytes * 1024 * 1024)
+        try:
+            for name, line in (("redirect", f"wc -l < {data.name}"), ("cat_pipe", f"cat {data.name} | wc -l")):
+                start = time.perf_counter()
+                mysh.run_pipeline(parse_line(line), devnull)
+                results[f"{name}_MBps"] = megabytes / (time.perf_counter() - start)
+        finally:
+            os.close(devnull)
+    return results
+
+
+def bench_capture(megabytes=64):
+    """
+    How fast var -s style capture reads a large output, alone and through a pipeline.
+    """
+    results = {}
+    for name, command in (("single", f"head -c {megabytes}M /dev/zero"),
+                          ("pipeline", f"head -c {megabytes}M /dev/zero | cat")):
+        start = time.perf_counter()
+        mysh.execute_command_and_capture_output(command)
+        results[f"{name}_MBps"] = megabytes / (time.perf_counter() - start)
+    return results
+
+
+def bench_substitution(count=4, seconds=0.1, runs=50):
+    """
+    A line with count slow $(...) substitutions against capturing the same commands
+    one at a time with var -s, plus the cost of a single fast substitution.
+    """
+    slow = f"sh -c 'sleep {seconds}; echo x'"
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        line = parse_line("echo " + " ".join(f"$({slow} {i})" for i in range(count)))
+        start = time.perf_counter()
+        mysh.run_pipeline(line, devnull)
+        concurrent = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(count):
+            mysh.execute_command_and_capture_output(f"{slow} {i}")
+        sequential = time.perf_counter() - start
+        single = _per_call(lambda: mysh.run_pipeline(parse_line("echo $(echo x)"), devnull), runs)
+        double = _per_call(lambda: mysh.run_pipeline(parse_line("echo $(echo x) $(echo y)"), devnull), runs)
+    finally:
+        os.close(devnull)
+    return {
+        f"concurrent_{count}_ms": concurrent * 1e3,
+        f"sequential_{count}_ms": sequential * 1e3,
+        "single_ms": single * 1e3,
+        "two_ms": double * 1e3,
+    }
+
+
+def bench_timeout(runs=300):
+    """
+    Cost of running true under the timeout watchdog and under a resource limit,
+    which needs fork and exec instead of posix_spawn.
+    """
+    results = {}
+    for name, line in (("plain", "true"), ("timeout", "timeout 10 true"),
+                       ("limit", "limit -n 64 true"), ("timeout_killed_1ms", "timeout 0.001 sleep 1")):
+        pipeline = parse_line(line)
+        results[f"{name}_us"] = _per_call(lambda: mysh.run_pipeline(pipeline), runs) * 1e6
+    return results
+
+
+def bench_lists(commands=200):
+    """
+    A script running the pwd builtin commands times, one per line, against the same
+    commands joined into a single ; list, and a && chain cut short by its first failure.
+    """
+    saved_stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        lines = ["pwd"] * commands
+        per_line = _per_call(lambda: mysh.run_batch(lines), 5)
+        joined = ["; ".join(lines)]
+        mysh.parse_line(joined[0])
+        one_line = _per_call(lambda: mysh.run_batch(joined), 5)
+        chain = ["false && " + " && ".join(["true"] * commands)]
+        short_circuit = _per_call(lambda: mysh.run_batch(chain), 5)
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+        os.close(devnull)
+    return {
+        "per_line_us": per_line / commands * 1e6,
+        "one_list_us": one_line / commands * 1e6,
+        "short_circuit_ms": short_circuit * 1e3,
+    }
+
+
+def bench_startup(runs=20):
+    """
+    Wall time of a cold 'mysh.py -c exit', interpreter start included.
+    """
+    argv = [sys.executable, os.path.join(SHELL_DIR, 'mysh.py'), '-c', 'exit']
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, check=True)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {"median_ms": timings[len(timings) // 2] * 1e3, "min_ms": timings[0] * 1e3}
+
+
+def bench_server(runs=200):
+    """
+    Latency of a -c batch through a --serve worker against a cold mysh.py -c.
+    """
+    from server import connect
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'mysh.sock')
+        server = subprocess.Popen([sys.executable, os.path.join(SHELL_DIR, 'mysh.py'), '--serve', path])
+        try:
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            request = {"cwd": tmp, "command": "true", "script": None, "fail_fast": False}
+            session = _per_call(lambda: connect(path, request), runs)
+        finally:
+            server.terminate()
+            server.wait()
+    argv = [sys.executable, os.path.join(SHELL_DIR, 'mysh.py'), '-c', 'true']
+    cold = _per_call(lambda: subprocess.run(argv, check=True), runs // 10)
+    return {"session_ms": session * 1e3, "cold_start_ms": cold * 1e3}
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "lookup": bench_lookup,
+    "glob": bench_glob,
+    "spawn": bench_spawn,
+    "environ": bench_environ,
+    "pipeline": bench_pipeline,
+    "tee": bench_tee,
+    "redirect": bench_redirect,
+    "capture": bench_capture,
+    "substitution": bench_substitution,
+    "timeout": bench_timeout,
+    "lists": bench_lists,
+    "startup": bench_startup,
+    "server": bench_server,
+}
+
+
+def main():
+    args = sys.argv[1:]
+    as_json = '--json' in args
+    names = [arg for arg in args if arg != '--json'] or list(BENCHMARKS)
+
+    results = {}
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"bench: unknown benchmark: {name}", file=sys.stderr)
+            sys.exit(2)
+        results[name] = BENCHMARKS[name]()
+        if not as_json:
+            for key, value in results[name].items():
+                print(f"{name}.{key}: {value:.1f}")
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
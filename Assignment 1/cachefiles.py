@@ -0,0 +1,26 @@
+import os
+
+
+def cache_path(*names):
+    """
+    Returns the path of names under the shell's cache directory, $XDG_CACHE_HOME/mysh
+    (or ~/.cache/mysh).
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "mysh", *names)
+
+
+def write_atomically(path, data, mode=0o666):
+    """
+    Writes data to a temporary file beside path, creating the directory if needed,
+    and renames it over path, so readers see either the old file or the new one.
+    Raises OSError.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with open(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
@@ -0,0 +1,102 @@
+import os
+import time
+import marshal
+
+from cachefiles import cache_path, write_atomically
+
+CAPTURE_CACHE_SIZE = 128
+CAPTURE_CACHE_FORMAT = 1
+
+# key -> (expiry time or None, captured output), least recently used first
+_capture_cache = {}
+_stats = {"hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def make_key(command, cwd, variables, files):
+    """
+    Builds the cache key for a capture: the command text, the directory it runs in,
+    (name, value) pairs for the variables it depends on, and the mtimes of files.
+    """
+    return (CAPTURE_CACHE_FORMAT, command, cwd, tuple(variables),
+            tuple((path, _mtime(path)) for path in files))
+
+
+def _disk_path(key):
+    import hashlib
+    digest = hashlib.sha1(repr(key).encode(errors='surrogateescape')).hexdigest()
+    return cache_path("captures", digest)
+
+
+def _read_disk(key):
+    try:
+        with open(_disk_path(key), "rb") as f:
+            cached_key, entry = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return entry if cached_key == key else None
+
+
+def _write_disk(key, entry):
+    try:
+        write_atomically(_disk_path(key), marshal.dumps((key, entry)))
+    except OSError:
+        pass
+
+
+def _remember(key, entry):
+    _capture_cache[key] = entry
+    if len(_capture_cache) > CAPTURE_CACHE_SIZE:
+        del _capture_cache[next(iter(_capture_cache))]
+        _stats["evictions"] += 1
+
+
+def _fresh(entry, now):
+    return entry is not None and (entry[0] is None or entry[0] > now)
+
+
+def lookup(key, persistent=False):
+    """
+    Returns the cached output for key, or None on a miss. With persistent, the
+    on-disk store is checked after memory.
+    """
+    now = time.time()
+    entry = _capture_cache.pop(key, None)
+    if _fresh(entry, now):
+        _capture_cache[key] = entry
+        _stats["hits"] += 1
+        return entry[1]
+    if entry is not None:
+        _stats["expired"] += 1
+    if persistent:
+        entry = _read_disk(key)
+        if _fresh(entry, now):
+            _remember(key, entry)
+            _stats["disk_hits"] += 1
+            return entry[1]
+    _stats["misses"] += 1
+    return None
+
+
+def store(key, output, ttl=None, persistent=False):
+    """
+    Caches output under key for ttl seconds (for good when ttl is None).
+    """
+    entry = (None if ttl is None else time.time() + ttl, output)
+    _remember(key, entry)
+    if persistent:
+        _write_disk(key, entry)
+
+
+def clear():
+    _capture_cache.clear()
+
+
+def cache_stats():
+    return dict(_stats, entries=len(_capture_cache))
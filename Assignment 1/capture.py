@@ -0,0 +1,87 @@
+import os
+import codecs
+
+from variables import get_variable
+
+CAPTURE_CHUNK_SIZE = 1 << 16
+
+# Bytes that don't decode are kept as surrogates, so they survive the trip
+# into a variable and back out to a child unchanged.
+_decoder_factory = codecs.getincrementaldecoder('utf-8')
+
+
+class CaptureLimitError(Exception):
+    pass
+
+
+def capture_limit():
+    """
+    Returns the byte cap from $MYSH_CAPTURE_LIMIT, or None when captures are unbounded.
+    """
+    value = get_variable('MYSH_CAPTURE_LIMIT')
+    if not value:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise CaptureLimitError(f"invalid MYSH_CAPTURE_LIMIT: {value}")
+    return limit if limit > 0 else None
+
+
+def read_output(fd, limit=None):
+    """
+    Drains fd until every writer has closed it, decoding as the data arrives, and closes fd.
+
+    Reading happens while the children are still running, so they never block
+    on a full pipe. Raises CaptureLimitError as soon as more than limit bytes
+    have been read; closing the pipe then stops the writers with SIGPIPE.
+    """
+    decoder = _decoder_factory(errors='surrogateescape')
+    chunks = []
+    total = 0
+    try:
+        while True:
+            data = os.read(fd, CAPTURE_CHUNK_SIZE)
+            if not data:
+                break
+            total += len(data)
+            if limit is not None and total > limit:
+                raise CaptureLimitError(f"output exceeds {limit} bytes")
+            chunks.append(decoder.decode(data))
+        chunks.append(decoder.decode(b'', final=True))
+    finally:
+        os.close(fd)
+    return ''.join(chunks)
+
+
+def read_outputs(fds, limit=None):
+    """
+    Drains several fds at once until every writer of each has closed it, and closes
+    them. Returns the text read from each, in order.
+
+    The bytes are only decoded once an fd is finished. limit applies to each
+    fd separately, as in read_output().
+    """
+    import select
+    chunks = {fd: [] for fd in fds}
+    totals = dict.fromkeys(fds, 0)
+    poller = select.poll()
+    for fd in fds:
+        poller.register(fd, select.POLLIN)
+    remaining = len(fds)
+    try:
+        while remaining:
+            for fd, _ in poller.poll():
+                data = os.read(fd, CAPTURE_CHUNK_SIZE)
+                if not data:
+                    poller.unregister(fd)
+                    remaining -= 1
+                    continue
+                totals[fd] += len(data)
+                if limit is not None and totals[fd] > limit:
+                    raise CaptureLimitError(f"output exceeds {limit} bytes")
+                chunks[fd].append(data)
+    finally:
+        for fd in fds:
+            os.close(fd)
+    return [b''.join(chunks[fd]).decode(errors='surrogateescape') for fd in fds]
@@ -0,0 +1,86 @@
+import os
+
+# name -> [resolved path, directory it was found in, directory mtime, hits]
+_command_table = {}
+_hashed_path = None
+
+
+def _check_path_changed():
+    """
+    Drops every remembered location when PATH is not the one the table was built for.
+    """
+    global _hashed_path
+    current_path = os.environ.get('PATH', '')
+    if current_path != _hashed_path:
+        _command_table.clear()
+        _hashed_path = current_path
+
+
+def _dir_mtime(path_dir):
+    try:
+        return os.stat(path_dir or '.').st_mtime_ns
+    except OSError:
+        return None
+
+
+def _scan_path(cmd):
+    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+        possible_path = os.path.join(path_dir, cmd)
+        if os.path.exists(possible_path):
+            return possible_path, path_dir
+    return None, None
+
+
+def hash_command(cmd):
+    """
+    Scans PATH for cmd and stores the result in the table, returns the path or None.
+    """
+    _check_path_changed()
+    cmd_path, path_dir = _scan_path(cmd)
+    if cmd_path is None:
+        _command_table.pop(cmd, None)
+        return None
+    _command_table[cmd] = [cmd_path, path_dir, _dir_mtime(path_dir), 0]
+    return cmd_path
+
+
+def search_cmd_path(cmd):
+    """
+    Resolves a command name to a path, using the hash table before scanning PATH.
+    """
+    if '/' in cmd:
+        if os.path.exists(cmd):
+            return os.path.abspath(cmd)
+        return None
+
+    _check_path_changed()
+    entry = _command_table.get(cmd)
+    if entry is not None:
+        if _dir_mtime(entry[1]) == entry[2] and os.path.exists(entry[0]):
+            entry[3] += 1
+            return entry[0]
+        del _command_table[cmd]
+
+    cmd_path = hash_command(cmd)
+    if cmd_path:
+        _command_table[cmd][3] = 1
+        return cmd_path
+    if os.path.exists(cmd):
+        return os.path.abspath(cmd)
+    return None
+
+
+def hash_clear():
+    _command_table.clear()
+
+
+def hash_forget(cmd):
+    return _command_table.pop(cmd, None) is not None
+
+
+def hash_entries():
+    """
+    Returns (hits, name, path) for each remembered command, in insertion order.
+    """
+    _check_path_changed()
+    return [(entry[3], name, entry[0]) for name, entry in _command_table.items()]
@@ -0,0 +1,228 @@
+import os
+import sys
+from bisect import bisect_right
+
+from cachefiles import write_atomically
+
+HISTORY_FILE = ".mysh_history"
+HISTORY_MAX_BYTES = 8 << 20     # compact once the log grows past this
+HISTORY_KEEP_BYTES = 4 << 20    # newest distinct entries kept by compaction
+READLINE_ENTRIES = 1000         # how many recent entries up-arrow and Ctrl-R see
+
+# Every entry is one line of the log. The index next to it is a flat table of
+# native 8-byte offsets, one per entry, so entry n is found without reading
+# the log, and both files are only ever mapped, never read in full.
+_OFFSET_SIZE = 8
+
+_store = None
+
+
+def _encode(text):
+    return text.encode(errors='surrogateescape')
+
+
+def _decode(data):
+    return bytes(data).decode(errors='surrogateescape')
+
+
+def _map_file(path):
+    """
+    Maps a whole file read-only. Returns b'' when it is missing or empty.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return b''
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return b''
+        import mmap
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+def _pack_offsets(offsets):
+    return b''.join(offset.to_bytes(_OFFSET_SIZE, sys.byteorder) for offset in offsets)
+
+
+class HistoryStore:
+    """
+    The history log of one MYSHDOTDIR, with its offset index.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.last_line = None
+
+    def _load(self):
+        """
+        Maps the log and its offset table, rebuilding the index if it does not match the log.
+        """
+        log = _map_file(self.path)
+        index = _map_file(self.index_path)
+        offsets = None
+        if len(index) % _OFFSET_SIZE == 0:
+            offsets = memoryview(index).cast('Q')
+        if offsets is None or not self._index_matches(log, offsets):
+            offsets = self._rebuild_index(log)
+        return log, offsets
+
+    @staticmethod
+    def _index_matches(log, offsets):
+        # only the ends are checked, so this costs the same for any history size
+        if not offsets:
+            return not log
+        return offsets[0] == 0 and offsets[-1] < len(log) and log.find(b'\n', offsets[-1]) == len(log) - 1
+
+    def _rebuild_index(self, log):
+        offsets = []
+        start = 0
+        while start < len(log):
+            offsets.append(start)
+            end = log.find(b'\n', start)
+            if end == -1:
+                break
+            start = end + 1
+        try:
+            write_atomically(self.index_path, _pack_offsets(offsets), 0o600)
+        except OSError:
+            pass
+        return offsets
+
+    @staticmethod
+    def _entry(log, offsets, number):
+        start = offsets[number]
+        end = offsets[number + 1] - 1 if number + 1 < len(offsets) else log.find(b'\n', start)
+        return log[start:end if end != -1 else len(log)]
+
+    def count(self):
+        return len(self._load()[1])
+
+    def entries(self, first=0, last=None):
+        """
+        Returns (number, line) for entries first to last (exclusive), numbered from 1.
+        """
+        log, offsets = self._load()
+        last = len(offsets) if last is None else min(last, len(offsets))
+        return [(n + 1, _decode(self._entry(log, offsets, n))) for n in range(max(first, 0), last)]
+
+    def append(self, line):
+        """
+        Adds a line, skipping it when it repeats the previous entry, and compacts the log once it is too big.
+        """
+        line = line.rstrip('\n')
+        if not line.strip():
+            return
+        if self.last_line is None:
+            log, offsets = self._load()
+            self.last_line = _decode(self._entry(log, offsets, len(offsets) - 1)) if offsets else ''
+        if line == self.last_line:
+            return
+        data = _encode(line.replace('\n', ' ')) + b'\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, _pack_offsets([end - len(data)]))
+        finally:
+            os.close(fd)
+        self.last_line = line
+        if end > HISTORY_MAX_BYTES:
+            self.compact()
+
+    def search(self, text, prefix=False):
+        """
+        Returns (number, line) for entries containing text (or starting with it
+        when prefix is set), newest first and each distinct line once.
+
+        The log is searched with rfind over the mapping, and a match's entry is
+        found by bisecting the offset table, so only matching entries are decoded.
+        """
+        log, offsets = self._load()
+        needle = b'\n' + _encode(text) if prefix else _encode(text)
+        found = []
+        seen = set()
+        pos = len(log)
+        while pos > 0:
+            pos = log.rfind(needle, 0, pos)
+            if pos == -1:
+                if prefix and log[:len(needle) - 1] == needle[1:]:
+                    pos = -1
+                else:
+                    break
+            number = bisect_right(offsets, pos + 1 if prefix else pos) - 1
+            entry = self._entry(log, offsets, number)
+            if entry not in seen:
+                seen.add(entry)
+                found.append((number + 1, _decode(entry)))
+            pos = offsets[number] - 1 if prefix else offsets[number]
+        return found
+
+    def compact(self):
+        """
+        Rewrites the log with the newest HISTORY_KEEP_BYTES of distinct entries, keeping each line's latest use.
+        """
+        log, offsets = self._load()
+        kept = []
+        seen = set()
+        size = 0
+        for number in range(len(offsets) - 1, -1, -1):
+            entry = bytes(self._entry(log, offsets, number))
+            if entry in seen:
+                continue
+            size += len(entry) + 1
+            if size > HISTORY_KEEP_BYTES:
+                break
+            seen.add(entry)
+            kept.append(entry)
+        kept.reverse()
+        new_offsets = []
+        position = 0
+        for entry in kept:
+            new_offsets.append(position)
+            position += len(entry) + 1
+        write_atomically(self.path, b''.join(entry + b'\n' for entry in kept), 0o600)
+        write_atomically(self.index_path, _pack_offsets(new_offsets), 0o600)
+
+    def clear(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self.last_line = ''
+
+
+def history_store():
+    """
+    Returns the store for the current MYSHDOTDIR (or home directory).
+    """
+    global _store
+    path = os.path.join(os.getenv("MYSHDOTDIR") or os.path.expanduser("~"), HISTORY_FILE)
+    if _store is None or _store.path != path:
+        _store = HistoryStore(path)
+    return _store
+
+
+def load_readline_history(store):
+    """
+    Gives readline the newest READLINE_ENTRIES entries for up-arrow and Ctrl-R.
+    Returns False when readline is not available.
+    """
+    try:
+        import readline
+    except ImportError:
+        return False
+    try:
+        count = store.count()
+        for _, line in store.entries(count - READLINE_ENTRIES, count):
+            readline.add_history(line)
+    except OSError:
+        pass
+    return True
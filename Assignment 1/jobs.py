@@ -0,0 +1,156 @@
+import os
+import signal
+
+from limits import forget as forget_deadline
+
+RUNNING = "Running"
+STOPPED = "Stopped"
+DONE = "Done"
+
+# pgid -> Job for every background or stopped pipeline
+_job_table = {}
+
+
+class Job:
+    """
+    A pipeline running in its own process group, or, when grouped is False, a
+    foreground pipeline left in the shell's group and known by its first pid.
+    """
+    def __init__(self, pgid, pids, command, job_id=None, grouped=True):
+        self.pgid = pgid
+        self.grouped = grouped
+        self.pids = pids              # None for stages that never started
+        self.command = command
+        self.job_id = job_id
+        self.state = RUNNING
+        self.statuses = {}            # pid -> exit status, filled in as children are reaped
+        self.usage = {}               # pid -> resource usage from wait4()
+
+    def record(self, pid, wait_status, usage=None):
+        if os.WIFSTOPPED(wait_status):
+            self.state = STOPPED
+        elif os.WIFCONTINUED(wait_status):
+            self.state = RUNNING
+        else:
+            self.statuses[pid] = exit_status(wait_status)
+            self.usage[pid] = usage
+            if self.finished():
+                self.state = DONE
+
+    def finished(self):
+        return all(pid is None or pid in self.statuses for pid in self.pids)
+
+    def exit_statuses(self):
+        return [self.statuses.get(pid, 127) for pid in self.pids]
+
+
+def exit_status(wait_status):
+    exit_code = os.waitstatus_to_exitcode(wait_status)
+    return exit_code if exit_code >= 0 else 128 - exit_code
+
+
+def reap_jobs(signum=None, frame=None):
+    """
+    SIGCHLD handler: collects whatever has changed in the background jobs without blocking.
+
+    Only the process groups in the job table are waited on, so the children of
+    a foreground pipeline are left for wait_for_job().
+    """
+    for job in list(_job_table.values()):
+        if job.state == DONE:
+            continue
+        while job.state != DONE:
+            try:
+                pid, wait_status, usage = os.wait4(-job.pgid, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
+            except ChildProcessError:
+                job.state = DONE
+                break
+            if pid == 0:
+                break
+            job.record(pid, wait_status, usage)
+        if job.state == DONE:
+            # once reaped, the pgid can be reused by an unrelated group, so a
+            # timeout must not fire at it even if the job is never waited for
+            forget_deadline(job.pgid)
+
+
+def wait_for_job(job, untraced=False):
+    """
+    Blocks until every child of job has exited, or until it stops when untraced is set.
+    """
+    options = os.WUNTRACED if untraced else 0
+    while not job.finished():
+        try:
+            if job.grouped:
+                pid, wait_status, usage = os.wait4(-job.pgid, options)
+            else:
+                waiting = next(pid for pid in job.pids if pid is not None and pid not in job.statuses)
+                pid, wait_status, usage = os.wait4(waiting, options)
+        except ChildProcessError:
+            break
+        job.record(pid, wait_status, usage)
+        if job.state == STOPPED:
+            return job
+    job.state = DONE
+    return job
+
+
+def add_job(job):
+    """
+    Puts job in the table under the lowest free job number and returns it.
+    """
+    if job.job_id is None:
+        used = {other.job_id for other in _job_table.values()}
+        job.job_id = 1
+        while job.job_id in used:
+            job.job_id += 1
+    _job_table[job.pgid] = job
+    # children that exited before the job was in the table were skipped by the handler
+    reap_jobs()
+    return job
+
+
+def remove_job(job):
+    _job_table.pop(job.pgid, None)
+    # a background job's timeout must not outlive it
+    forget_deadline(job.pgid)
+
+
+def all_jobs():
+    return sorted(_job_table.values(), key=lambda job: job.job_id)
+
+
+def find_job(spec):
+    """
+    Looks up a job by %N, N, a pid in it, or %%/%+/no spec for the most recent one.
+    """
+    jobs = all_jobs()
+    if spec in (None, '%', '%%', '%+'):
+        return jobs[-1] if jobs else None
+    try:
+        number = int(spec[1:] if spec.startswith('%') else spec)
+    except ValueError:
+        return None
+    if not spec.startswith('%'):
+        for job in jobs:
+            if number in job.pids:
+                return job
+    for job in jobs:
+        if job.job_id == number:
+            return job
+    return None
+
+
+def finished_jobs():
+    """
+    Removes and returns the jobs that have finished since the last call.
+    """
+    done = [job for job in all_jobs() if job.state == DONE]
+    for job in done:
+        remove_job(job)
+    return done
+
+
+def continue_job(job):
+    os.killpg(job.pgid, signal.SIGCONT)
+    job.state = RUNNING
@@ -0,0 +1,229 @@
+import os
+import sys
+import signal
+
+from variables import child_environ, get_variable
+from limits import apply_limits
+
+USE_POSIX_SPAWN = hasattr(os, 'posix_spawn')
+
+# The shell ignores these (Python itself ignores SIGPIPE and SIGXFSZ), and
+# ignored dispositions survive exec, so children get them reset to default.
+_DEFAULT_SIGNALS = [signal.SIGINT, signal.SIGTSTP, signal.SIGTTIN, signal.SIGTTOU, signal.SIGPIPE]
+if hasattr(signal, 'SIGXFSZ'):
+    _DEFAULT_SIGNALS.append(signal.SIGXFSZ)
+
+
+PIPE_MAX_SIZE_PATH = '/proc/sys/fs/pipe-max-size'
+_pipe_max_size = None
+
+
+def _max_pipe_size():
+    global _pipe_max_size
+    if _pipe_max_size is None:
+        try:
+            with open(PIPE_MAX_SIZE_PATH) as f:
+                _pipe_max_size = int(f.read())
+        except (OSError, ValueError):
+            _pipe_max_size = 1 << 20
+    return _pipe_max_size
+
+
+def pipe_size():
+    """
+    Returns the pipe buffer size asked for by $MYSH_PIPE_SIZE (bytes, or with a K or M
+    suffix) capped by the system maximum, or None to keep the default. Raises ValueError.
+    """
+    value = get_variable('MYSH_PIPE_SIZE')
+    if not value:
+        return None
+    multiplier = {'K': 1 << 10, 'M': 1 << 20}.get(value[-1].upper(), 1)
+    digits = value[:-1] if multiplier != 1 else value
+    if not digits.isdigit() or int(digits) == 0:
+        raise ValueError(f"invalid MYSH_PIPE_SIZE: {value}")
+    return min(int(digits) * multiplier, _max_pipe_size())
+
+
+# execve() needs room for the argument and environment strings and a pointer to
+# each within ARG_MAX; xargs leaves the same headroom on top.
+ARG_MAX_HEADROOM = 2048
+_POINTER_SIZE = 8
+
+
+def arg_batch_jobs():
+    """
+    Returns how many invocations $MYSH_ARG_BATCH allows at once when an argument
+    list is split to fit ARG_MAX, or 0 when splitting is off. Raises ValueError.
+    """
+    value = get_variable('MYSH_ARG_BATCH')
+    if not value:
+        return 0
+    if not value.isdigit() or int(value) == 0:
+        raise ValueError(f"invalid MYSH_ARG_BATCH: {value}")
+    return int(value)
+
+
+def _arg_size(arg):
+    return len(arg.encode(errors='surrogateescape')) + 1 + _POINTER_SIZE
+
+
+def argument_space():
+    """
+    Returns how many bytes of ARG_MAX are left for arguments by the child's environment.
+    """
+    environ_size = sum(len(name) + len(value) + 2 + _POINTER_SIZE
+                       for name, value in child_environ().items())
+    return os.sysconf('SC_ARG_MAX') - environ_size - ARG_MAX_HEADROOM
+
+
+def split_arguments(prefix, items, suffix, space):
+    """
+    Splits prefix + items + suffix into argument lists of at most space bytes, like
+    xargs: each gets the whole prefix and suffix and as many items as fit, in order.
+    Raises OSError(E2BIG) when not even one item fits.
+    """
+    fixed = sum(map(_arg_size, prefix)) + sum(map(_arg_size, suffix))
+    batches = []
+    batch = []
+    size = fixed
+    for item in items:
+        item_size = _arg_size(item)
+        if fixed + item_size > space:
+            import errno
+            raise OSError(errno.E2BIG, os.strerror(errno.E2BIG))
+        if size + item_size > space:
+            batches.append(prefix + batch + suffix)
+            batch = []
+            size = fixed
+        batch.append(item)
+        size += item_size
+    batches.append(prefix + batch + suffix)
+    return batches
+
+
+def make_pipe(size=None):
+    """
+    os.pipe(), with the buffer resized to size bytes where the system allows it.
+    """
+    read_fd, write_fd = os.pipe()
+    if size is not None:
+        import fcntl
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, size)
+        except (OSError, AttributeError):
+            # over the per-user limit on pipe memory, or not Linux: keep the default
+            pass
+    return read_fd, write_fd
+
+
+def spawn(args, cmd_path=None, stdin=None, stdout=None, pgroup=0, stderr=None, limits=()):
+    """
+    Starts args as a child process and returns its pid.
+
+    stdin/stdout/stderr are fds to wire onto 0/1/2 in the child, and the child joins
+    process group pgroup (0 starts a new group led by the child, None leaves it
+    in the shell's group). cmd_path is the
+    already resolved executable; without it PATH is searched. limits are
+    (resource name, value) pairs set with setrlimit in the child, which
+    posix_spawn cannot do, so they make it fork and exec. Raises OSError if
+    the command cannot be started.
+    """
+    if not USE_POSIX_SPAWN or limits:
+        return fork_exec(args, cmd_path, stdin, stdout, pgroup, stderr, limits)
+
+    file_actions = []
+    for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2)):
+        if fd is not None and fd != target:
+            file_actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+    for fd in {stdin, stdout, stderr}:
+        if fd is not None and fd > 2:
+            file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+
+    group = {} if pgroup is None else {"setpgroup": pgroup}
+    if cmd_path is not None:
+        return os.posix_spawn(cmd_path, args, child_environ(), file_actions=file_actions,
+                              setsigdef=_DEFAULT_SIGNALS, **group)
+    return os.posix_spawnp(args[0], args, child_environ(), file_actions=file_actions,
+                           setsigdef=_DEFAULT_SIGNALS, **group)
+
+
+def _wire_fds(stdin, stdout, stderr):
+    for fd, target in ((stdin, 0), (stdout, 1), (stderr, 2)):
+        if fd is not None and fd != target:
+            os.dup2(fd, target)
+    for fd in {stdin, stdout, stderr}:
+        if fd is not None and fd > 2:
+            os.close(fd)
+
+
+def fork_exec(args, cmd_path=None, stdin=None, stdout=None, pgroup=0, stderr=None, limits=()):
+    """
+    The same as spawn(), using os.fork() and exec. Only used where posix_spawn is
+    missing or resource limits have to be set.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            for sig in _DEFAULT_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            if pgroup is not None:
+                os.setpgid(0, pgroup)
+            _wire_fds(stdin, stdout, stderr)
+            apply_limits(limits)
+            if cmd_path is not None:
+                os.execve(cmd_path, args, child_environ())
+            else:
+                os.execvpe(args[0], args, child_environ())
+        except OSError as e:
+            print(f"mysh: {args[0]}: {e.strerror}", file=sys.stderr)
+        except ValueError as e:
+            print(f"mysh: limit: {e}", file=sys.stderr)
+        finally:
+            os._exit(127)
+
+    if pgroup is not None:
+        try:
+            os.setpgid(pid, pgroup or pid)
+        except OSError:
+            # the child already did it and exec'd
+            pass
+    return pid
+
+
+def fork_call(func, stdin=None, stdout=None, pgroup=0, stderr=None, limits=()):
+    """
+    Runs func() in a forked copy of the shell wired like spawn(), without exec.
+
+    The child exits with func's return value (or its SystemExit code), so shell
+    code such as a builtin can be a pipeline stage. Returns the child's pid.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            for sig in _DEFAULT_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            if pgroup is not None:
+                os.setpgid(0, pgroup)
+            _wire_fds(stdin, stdout, stderr)
+            apply_limits(limits)
+            status = func()
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+        except BaseException as e:
+            print(f"mysh: error: {e}", file=sys.stderr)
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+
+    if pgroup is not None:
+        try:
+            os.setpgid(pid, pgroup or pid)
+        except OSError:
+            pass
+    return pid
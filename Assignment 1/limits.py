@@ -0,0 +1,173 @@
+import os
+import time
+import heapq
+import signal
+
+TIMEOUT = "timeout"
+LIMIT = "limit"
+PREFIXES = (TIMEOUT, LIMIT)
+
+TIMEOUT_STATUS = 124     # like coreutils timeout
+PREFIX_ERROR_STATUS = 125
+KILL_GRACE = 1.0         # seconds between SIGTERM and SIGKILL for a group that outlives its deadline
+
+# option of the limit prefix -> the resource it lowers
+LIMIT_OPTIONS = {
+    '-t': 'RLIMIT_CPU',
+    '-v': 'RLIMIT_AS',
+    '-n': 'RLIMIT_NOFILE',
+}
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+# Every deadline of every pipeline is in this heap of (time, pgid, signal), and
+# one ITIMER_REAL timer is always set for the earliest, so watching a pipeline
+# never costs a thread and the shell only wakes up when something is due.
+_deadlines = []
+_expired = set()
+_handler_installed = False
+
+
+def parse_duration(text):
+    """
+    Reads a duration such as 5, 2.5s, 10m, 1h or 1d into seconds. Raises ValueError.
+    """
+    multiplier = _DURATION_UNITS.get(text[-1:], None)
+    number = text[:-1] if multiplier is not None else text
+    try:
+        seconds = float(number) * (multiplier or 1)
+    except ValueError:
+        seconds = -1
+    if not seconds > 0 or seconds == float('inf'):
+        raise ValueError(f"invalid duration: {text}")
+    return seconds
+
+
+def parse_size(text):
+    """
+    Reads a byte count, optionally with a K, M or G suffix. Raises ValueError.
+    """
+    multiplier = _SIZE_UNITS.get(text[-1:].upper(), 1)
+    digits = text[:-1] if multiplier != 1 else text
+    if not digits.isdigit() or int(digits) == 0:
+        raise ValueError(f"invalid size: {text}")
+    return int(digits) * multiplier
+
+
+def _limit_value(option, text):
+    if option == '-t':
+        return max(1, round(parse_duration(text)))
+    if option == '-v':
+        return parse_size(text)
+    if not text.isdigit():
+        raise ValueError(f"invalid count: {text}")
+    return int(text)
+
+
+def parse_prefixes(args):
+    """
+    Reads the timeout and limit prefixes at the start of args:
+
+        timeout DURATION ...
+        limit [-t cpu-seconds] [-v address-space] [-n open-files] ...
+
+    Returns (seconds, limits, count): the timeout or None, a list of (resource
+    name, value) pairs, and how many words the prefixes took. Raises ValueError.
+    """
+    seconds = None
+    limits = []
+    i = 0
+    while i < len(args) and args[i] in PREFIXES:
+        if args[i] == TIMEOUT:
+            if i + 1 >= len(args):
+                raise ValueError("timeout: missing duration")
+            try:
+                seconds = parse_duration(args[i + 1])
+            except ValueError as e:
+                raise ValueError(f"timeout: {e}")
+            i += 2
+            continue
+        i += 1
+        start = i
+        while i < len(args) and args[i] in LIMIT_OPTIONS:
+            if i + 1 >= len(args):
+                raise ValueError(f"limit: {args[i]}: missing value")
+            try:
+                limits.append((LIMIT_OPTIONS[args[i]], _limit_value(args[i], args[i + 1])))
+            except ValueError as e:
+                raise ValueError(f"limit: {args[i]}: {e}")
+            i += 2
+        if i == start:
+            raise ValueError("limit: expected -t, -v or -n")
+    if i == len(args):
+        raise ValueError(f"{args[0]}: missing command")
+    return seconds, limits, i
+
+
+def apply_limits(limits):
+    """
+    Lowers the soft limits of the calling process; run in a child just before exec.
+    A value above the hard limit is capped at it.
+    """
+    if not limits:
+        return
+    import resource
+    for name, value in limits:
+        which = getattr(resource, name)
+        _, hard = resource.getrlimit(which)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(which, (value, hard))
+
+
+def _arm():
+    if _deadlines:
+        delay = max(_deadlines[0][0] - time.monotonic(), 0.001)
+        signal.setitimer(signal.ITIMER_REAL, delay)
+    else:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _alarm(signum, frame):
+    """
+    SIGALRM handler: signals every process group whose deadline has passed and
+    re-arms the timer for the next one.
+    """
+    now = time.monotonic()
+    while _deadlines and _deadlines[0][0] <= now:
+        _, pgid, sig = heapq.heappop(_deadlines)
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            continue
+        _expired.add(pgid)
+        if sig == signal.SIGTERM:
+            heapq.heappush(_deadlines, (now + KILL_GRACE, pgid, signal.SIGKILL))
+    _arm()
+
+
+def watch(pgid, seconds):
+    """
+    Kills process group pgid once seconds have passed, unless forget() is called first.
+    """
+    global _handler_installed
+    if not _handler_installed:
+        signal.signal(signal.SIGALRM, _alarm)
+        _handler_installed = True
+    heapq.heappush(_deadlines, (time.monotonic() + seconds, pgid, signal.SIGTERM))
+    _arm()
+
+
+def forget(pgid):
+    """
+    Stops watching pgid, returning True if its deadline had already passed.
+    """
+    if any(entry[1] == pgid for entry in _deadlines):
+        _deadlines[:] = [entry for entry in _deadlines if entry[1] != pgid]
+        heapq.heapify(_deadlines)
+        _arm()
+    if pgid in _expired:
+        _expired.discard(pgid)
+        return True
+    return False
@@ -1,59 +1,113 @@
+import time
+_startup_began = time.perf_counter()
+
 import os
-import shlex
+import io
 import sys
-import re
 import signal
-import json
-from parsing import parse_myshrc, split_by_pipe_op, parse_command, expand_variables, handle_syntax_errors
+from parsing import parse_myshrc, parse_line, expand_stage, expand_redirects, is_valid_name, MyshSyntaxError, SPECIAL_PARAMETERS
+from parsing import pipeline_variables, lookup_variable, expand_stage_fields, clear_glob_cache
+from parsing import set_substitution_runner, install_substitutions, list_pipelines
+from parsing import AND_LIST, OR_LIST
+from parsing import READ, WRITE, APPEND, DUPLICATE
+from launcher import spawn, fork_call, make_pipe, pipe_size, arg_batch_jobs, argument_space, split_arguments
+from capture import read_output, read_outputs, capture_limit, CaptureLimitError
+from jobs import Job, RUNNING, STOPPED, reap_jobs, wait_for_job, add_job, remove_job, all_jobs, find_job, finished_jobs, continue_job
+from cmdhash import search_cmd_path, hash_command, hash_clear, hash_forget, hash_entries
+from variables import get_variable, set_variable, export_variable, exported_variables
+from capcache import make_key as make_cache_key, lookup as cache_lookup, store as cache_store
+from capcache import clear as clear_capture_cache, cache_stats
+from history import history_store, load_readline_history
+from limits import PREFIXES, TIMEOUT_STATUS, PREFIX_ERROR_STATUS, parse_prefixes, watch, forget as forget_deadline
+import tracing
+
+_imports_done = time.perf_counter()
+
+BUILTIN_COMMANDS = ["exit", "pwd", "cd", "var", "which", "hash", "jobs", "wait", "fg", "bg", "parallel", "export", "times", "cache", "history", "tee"]
+STATEFUL_BUILTINS = ["exit", "cd", "var", "export", "cache"]
+# Builtins that work on fds 0 and 1 directly, so they always run in a forked child.
+STREAM_BUILTINS = ["tee"]
+
+CAPTURE = 'capture'
+REDIRECT_FLAGS = {
+    READ: os.O_RDONLY,
+    WRITE: os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+    APPEND: os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+}
+BATCH_BUFFER_SIZE = 1 << 20
+USAGE = ("usage: mysh.py [-i] [-e | --fail-fast] [--startup-profile] [--trace file] [-c command | script]\n"
+         "       mysh.py --serve socket [--workers N]\n"
+         "       mysh.py --connect socket [-e | --fail-fast] [-c command | script]")
+
+# Exit status of the builtin being run, set to 1 by builtin_error().
+builtin_status = 0
+
+# True when $? came from a pipeline on the left of && or ||, whose failure
+# does not stop the shell under -e, like sh -e. Set by run_list().
+status_is_condition = False
 
-BUILTIN_COMMANDS = ["exit", "pwd", "cd", "var", "which"]
+# Set by main() when reading commands from a terminal. Only then does the
+# shell prompt and hand the terminal to foreground pipelines.
+interactive = False
 
 def setup_signals():
     signal.signal(signal.SIGTTIN, signal.SIG_IGN)
     signal.signal(signal.SIGTTOU, signal.SIG_IGN)
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, reap_jobs)
 
-def setup_signals_pipe():
-    signal.signal(signal.SIGTTIN, signal.SIG_IGN)
-    signal.signal(signal.SIGTTOU, signal.SIG_IGN)
-    signal.signal(signal.SIGINT, signal_handler)
+def parse_command_expanded(command_str):
+    stages = parse_line(command_str).stages
+    if not stages:
+        return []
+    return expand_stage(stages[0])
 
-def signal_handler(sig, frame):
-    pgid = os.getpgid(0)
-    os.killpg(pgid, signal.SIGINT)
+def builtin_error(message):
+    """
+    Reports a builtin's error and makes it exit with status 1.
+    """
+    global builtin_status
+    print(message, file=sys.stderr)
+    builtin_status = 1
 
-def parse_command_expanded(command_str):
-    command_strs = shlex.shlex(command_str.replace('\\$', '\\\\$'), posix=True)
-    command_strs.whitespace_split = True
-    command_strs.escapedquotes = '"' + "'"
-    command_strs = list(command_strs)
-    command_strs = [expand_variables(cmd) for cmd in command_strs]
-    return command_strs
+def run_builtin(args):
+    """
+    Runs a builtin in the shell process and returns its exit status.
+    """
+    global builtin_status
+    outer_status = builtin_status
+    builtin_status = 0
+    tracing.counters["builtins"] += 1
+    try:
+        handle_builtin(args[0], args)
+        return builtin_status
+    finally:
+        builtin_status = outer_status
 
 def handle_builtin(command, args):
+    global builtin_status
     if command == "exit":
         if len(args) > 2:
-            print("exit: too many arguments", file=sys.stderr)
+            builtin_error("exit: too many arguments")
         elif len(args) == 2:
             try:
                 exit_code = int(args[1])
                 sys.exit(exit_code)
             except ValueError:
-                print(f"exit: non-integer exit code provided: {args[1]}", file=sys.stderr)
+                builtin_error(f"exit: non-integer exit code provided: {args[1]}")
         else:
             sys.exit(0)
         return True
 
     elif command == "pwd":
         if len(args) > 2:
-            print(f"pwd: invalid option: {args[1]}", file=sys.stderr)
+            builtin_error(f"pwd: invalid option: {args[1]}")
         elif len(args) == 2:
             if args[1] == "-P":
                 print(os.path.realpath(os.environ.get("PWD", os.getcwd())))
             else:
                 for option in args[1][1:]:
                     if option != 'P':
-                        print(f"pwd: invalid option: -{option}", file=sys.stderr)
+                        builtin_error(f"pwd: invalid option: -{option}")
                         break  
         elif len(args) == 1:
             print(os.environ.get("PWD", os.getcwd()))
@@ -61,77 +115,79 @@ def handle_builtin(command, args):
 
     elif command == "cd":
         if len(args) > 2:
-            print("cd: too many arguments", file=sys.stderr)
+            builtin_error("cd: too many arguments")
         elif len(args) == 1:
             os.chdir(os.path.expanduser("~"))
-            os.environ["PWD"] = os.path.expanduser("~")
+            set_variable("PWD", os.path.expanduser("~"), export=True)
         else:
             path = os.path.expanduser(args[1])
             try:
                 if path == "..":
                     os.chdir(path)
-                    os.environ["PWD"] = os.path.dirname(os.environ["PWD"])
+                    set_variable("PWD", os.path.dirname(os.environ["PWD"]), export=True)
                 else:
                     os.chdir(path)
                     if os.path.isabs(path):
-                        os.environ["PWD"] = os.path.realpath(path) if "-P" in args else path
+                        set_variable("PWD", os.path.realpath(path) if "-P" in args else path, export=True)
                     else:
                         new_path = os.path.normpath(os.path.join(os.environ["PWD"], path))
-                        os.environ["PWD"] = os.path.realpath(new_path) if "-P" in args else new_path
+                        set_variable("PWD", os.path.realpath(new_path) if "-P" in args else new_path, export=True)
             except FileNotFoundError:
-                print(f"cd: no such file or directory: {path}", file=sys.stderr)
+                builtin_error(f"cd: no such file or directory: {path}")
             except NotADirectoryError:
-                print(f"cd: not a directory: {path}", file=sys.stderr)
+                builtin_error(f"cd: not a directory: {path}")
             except PermissionError:
-                print(f"cd: permission denied: {path}", file=sys.stderr)
+                builtin_error(f"cd: permission denied: {path}")
         return True
 
     elif command == "var":
+        if len(args) == 1:
+            builtin_error("var: expected 2 arguments, got 0")
+            return True
         if args[1].startswith('-'):
             for option in args[1][1:]:
                 if option != 's':  
-                    print(f"var: invalid option: -{option}", file=sys.stderr)
+                    builtin_error(f"var: invalid option: -{option}")
                     return True
         
         if args[1] == '-s':
             if len(args) != 4:
-                print(f"var: expected 3 arguments with -s, got {len(args) - 1}", file=sys.stderr)
+                builtin_error(f"var: expected 3 arguments with -s, got {len(args) - 1}")
                 return True
             
             var_name = args[2]
             command_str = args[3]
-            command_str = command_str.replace('~', '/home', 1) 
 
-            if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', var_name):
-                print(f"var: invalid characters for variable {var_name}", file=sys.stderr)
+            if not is_valid_name(var_name):
+                builtin_error(f"var: invalid characters for variable {var_name}")
                 return True
 
             try:
                 command_output = execute_command_and_capture_output(command_str)
-                os.environ[var_name] = command_output  
+                set_variable(var_name, command_output)
             except Exception as e:
-                print(f"var: command failed with error: {e}", file=sys.stderr)
+                builtin_error(f"var: command failed with error: {e}")
                 return True
 
         else:
             if len(args) != 3:
-                print(f"var: expected 2 arguments, got {len(args) - 1}", file=sys.stderr)
+                builtin_error(f"var: expected 2 arguments, got {len(args) - 1}")
                 return True
             var_name = args[1]
             var_value = args[2]
 
-            if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', var_name):
-                print(f"var: invalid characters for variable {var_name}", file=sys.stderr)
+            if not is_valid_name(var_name):
+                builtin_error(f"var: invalid characters for variable {var_name}")
                 return True
 
-            os.environ[var_name] = var_value
+            set_variable(var_name, var_value)
 
         return True
 
     
     elif command == "which":
         if len(args) < 2:
-            print("usage: which command ...", file=sys.stderr)
+            builtin_error("usage: which command ...")
             return True
 
         for cmd in args[1:]:
@@ -146,302 +202,1047 @@ def handle_builtin(command, args):
                     print(f"{cmd} not found")
         return True
 
+    elif command == "hash":
+        names = args[1:]
+        if names and names[0] == '-r':
+            hash_clear()
+            names = names[1:]
+        elif names and names[0] == '-d':
+            for cmd in names[1:]:
+                if not hash_forget(cmd):
+                    builtin_error(f"hash: {cmd}: not found")
+            return True
+        elif names and names[0].startswith('-'):
+            builtin_error(f"hash: invalid option: {names[0]}")
+            return True
+
+        if not names:
+            if len(args) == 1:
+                entries = hash_entries()
+                if not entries:
+                    print("hash: hash table empty")
+                else:
+                    print("hits\tcommand")
+                    for hits, cmd, cmd_path in entries:
+                        print(f"{hits:4}\t{cmd_path}")
+            return True
+
+        for cmd in names:
+            if cmd in BUILTIN_COMMANDS:
+                continue
+            if not hash_command(cmd):
+                builtin_error(f"hash: {cmd}: not found")
+        return True
+
+
+    elif command == "jobs":
+        for job in all_jobs():
+            suffix = " &" if job.state == RUNNING else ""
+            print(f"[{job.job_id}]  {job.state:<24}{job.command}{suffix}")
+        finished_jobs()
+        return True
+
+    elif command == "wait":
+        if len(args) == 1:
+            for job in all_jobs():
+                if job.state != STOPPED:
+                    remove_job(job)
+                    wait_for_job(job)
+            return True
+        for spec in args[1:]:
+            job = find_job(spec)
+            if job is None:
+                builtin_error(f"wait: {spec}: no such job")
+                builtin_status = 127
+                continue
+            remove_job(job)
+            wait_for_job(job)
+            builtin_status = job.exit_statuses()[-1]
+        return True
+
+    elif command == "fg":
+        job = find_job(args[1] if len(args) > 1 else None)
+        if job is None:
+            builtin_error(f"fg: {args[1] if len(args) > 1 else 'current'}: no such job")
+            return True
+        remove_job(job)
+        print(job.command)
+        sys.stdout.flush()
+        terminal = give_terminal_to(job.pgid) if interactive else None
+        try:
+            continue_job(job)
+            wait_for_job(job, untraced=interactive)
+        finally:
+            if terminal is not None:
+                reclaim_terminal(terminal)
+        if job.state == STOPPED:
+            add_job(job)
+            print(f"\n[{job.job_id}]+  {STOPPED:<24}{job.command}")
+            builtin_status = 128 + signal.SIGTSTP
+        else:
+            builtin_status = job.exit_statuses()[-1]
+        return True
+
+    elif command == "bg":
+        job = find_job(args[1] if len(args) > 1 else None)
+        if job is None:
+            builtin_error(f"bg: {args[1] if len(args) > 1 else 'current'}: no such job")
+            return True
+        continue_job(job)
+        print(f"[{job.job_id}]+ {job.command} &")
+        return True
+
+    elif command == "parallel":
+        max_jobs = os.cpu_count() or 1
+        keep_order = False
+        halt = False
+        i = 1
+        while i < len(args) and args[i].startswith('-'):
+            if args[i] in ('-j', '--jobs'):
+                if i + 1 >= len(args) or not args[i + 1].isdigit() or int(args[i + 1]) < 1:
+                    builtin_error(f"parallel: {args[i]}: expected a positive number of jobs")
+                    return True
+                max_jobs = int(args[i + 1])
+                i += 1
+            elif args[i] in ('-k', '--keep-order'):
+                keep_order = True
+            elif args[i] == '--halt':
+                halt = True
+            elif args[i] == '--keep-going':
+                halt = False
+            else:
+                builtin_error(f"parallel: invalid option: {args[i]}")
+                return True
+            i += 1
+
+        template = args[i:]
+        if ':::' in template:
+            split_at = template.index(':::')
+            template, inputs = template[:split_at], template[split_at + 1:]
+        else:
+            inputs = read_output(os.dup(0)).splitlines()
+        if not template:
+            builtin_error("usage: parallel [-j N] [-k] [--keep-going | --halt] command [arg ...] [::: input ...]")
+            return True
+        if not inputs:
+            return True
+
+        from parallel import run_parallel
+        statuses = run_parallel(template, inputs, launch_parallel_job, max_jobs, keep_order, halt)
+        SPECIAL_PARAMETERS['PARALLEL_STATUS'] = ' '.join(str(status) for status in statuses)
+        failures = sum(1 for status in statuses if status != 0)
+        if failures or len(statuses) < len(inputs):
+            builtin_status = min(max(failures, 1), 101)
+        return True
+
+    elif command == "export":
+        if len(args) == 1:
+            for name, value in exported_variables():
+                print(f"export {name}={value}")
+            return True
+        for arg in args[1:]:
+            name, has_value, value = arg.partition('=')
+            if not is_valid_name(name):
+                builtin_error(f"export: invalid characters for variable {name}")
+                continue
+            export_variable(name, value if has_value else None)
+        return True
+
+    elif command == "cache":
+        if args[1:] == ['-s']:
+            for name, value in cache_stats().items():
+                print(f"{name}: {value}")
+            return True
+        if args[1:] == ['-c']:
+            clear_capture_cache()
+            return True
+        ttl = None
+        files = []
+        names = {'PATH'}
+        persistent = False
+        i = 1
+        while i < len(args) and args[i].startswith('-'):
+            if args[i] in ('-t', '-f', '-e'):
+                if i + 1 >= len(args):
+                    builtin_error(f"cache: {args[i]}: option requires an argument")
+                    return True
+                value = args[i + 1]
+                if args[i] == '-t':
+                    try:
+                        ttl = float(value)
+                    except ValueError:
+                        ttl = -1
+                    if ttl < 0:
+                        builtin_error(f"cache: -t: invalid number of seconds: {value}")
+                        return True
+                elif args[i] == '-f':
+                    files.append(os.path.abspath(value))
+                else:
+                    names.add(value)
+                i += 1
+            elif args[i] == '-p':
+                persistent = True
+            else:
+                builtin_error(f"cache: invalid option: {args[i]}")
+                return True
+            i += 1
+        if len(args) - i != 2:
+            builtin_error("usage: cache [-t seconds] [-f file]... [-e name]... [-p] name command | cache -s | cache -c")
+            return True
+
+        var_name, command_str = args[i], args[i + 1]
+        if not is_valid_name(var_name):
+            builtin_error(f"cache: invalid characters for variable {var_name}")
+            return True
+        try:
+            names.update(pipeline_variables(parse_line(command_str)))
+            key = make_cache_key(command_str, os.getcwd(),
+                                 [(name, lookup_variable(name)) for name in sorted(names)], files)
+            command_output = cache_lookup(key, persistent)
+            if command_output is None:
+                command_output = execute_command_and_capture_output(command_str)
+                if last_status() == 0:
+                    cache_store(key, command_output, ttl, persistent)
+            set_variable(var_name, command_output)
+        except Exception as e:
+            builtin_error(f"cache: command failed with error: {e}")
+        return True
+
+    elif command == "history":
+        store = history_store()
+        if len(args) == 3 and args[1] in ('-s', '-p'):
+            for number, line in store.search(args[2], prefix=args[1] == '-p'):
+                print(f"{number:5}  {line}")
+        elif args[1:] == ['-c']:
+            store.clear()
+        elif len(args) == 1 or (len(args) == 2 and args[1].isdigit()):
+            count = store.count()
+            first = count - int(args[1]) if len(args) == 2 else 0
+            for number, line in store.entries(first, count):
+                print(f"{number:5}  {line}")
+        else:
+            builtin_error("usage: history [n] | history -s text | history -p prefix | history -c")
+        return True
+
+    elif command == "tee":
+        files = args[1:]
+        append = bool(files) and files[0] == '-a'
+        if append:
+            files = files[1:]
+        elif files and files[0].startswith('-') and files[0] != '-':
+            builtin_error(f"tee: invalid option: {files[0]}")
+            return True
+        flags = os.O_WRONLY | os.O_CREAT | (0 if append else os.O_TRUNC)
+        fds = []
+        for path in files:
+            try:
+                fd = os.open(path, flags, 0o666)
+            except OSError as e:
+                builtin_error(f"tee: {path}: {e.strerror}")
+                continue
+            if append:
+                # splice() refuses O_APPEND files, so append by seeking to the end instead
+                os.lseek(fd, 0, os.SEEK_END)
+            fds.append(fd)
+        from streams import tee_stream
+        sys.stdout.flush()
+        try:
+            tee_stream(0, 1, fds)
+        except OSError as e:
+            builtin_error(f"tee: {e.strerror}")
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return True
+
+    elif command == "times":
+        if len(args) > 2 or (len(args) == 2 and args[1] != '-v'):
+            builtin_error(f"times: invalid option: {args[1]}")
+            return True
+        tracing.report_times(verbose=len(args) == 2)
+        return True
 
     else:
         return False
 
 
-def search_cmd_path(cmd):
-    cmd_path = None
-    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
-        possible_path = os.path.join(path_dir, cmd)
-        if os.path.exists(possible_path):
-            cmd_path = possible_path
-            break
-    if not cmd_path:
-        if os.path.exists(cmd):
-            cmd_path = os.path.abspath(cmd)
-    return cmd_path
+def launch_command(args, cmd_path=None, stdin=None, stdout=None, pgroup=0, stderr=None, limits=()):
+    """
+    Spawns a command, reporting failures the way the shell does. Returns the pid or None.
+    """
+    try:
+        return spawn(args, cmd_path, stdin, stdout, pgroup, stderr, limits)
+    except FileNotFoundError:
+        print(f"mysh: command not found: {args[0]}", file=sys.stderr)
+    except PermissionError:
+        print(f"mysh: permission denied: {args[0]}", file=sys.stderr)
+    except OSError as e:
+        print(f"mysh: error: {e}", file=sys.stderr)
+    return None
 
-def execute_pipeline(pipeline):
-    processes = []
-    prev_pipe_read = None
+def launch_parallel_job(args, stdout, stderr):
+    """
+    Starts one job of the parallel builtin with its input from /dev/null.
+    """
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    try:
+        if args[0] in BUILTIN_COMMANDS:
+            return fork_call(lambda: run_builtin(args), devnull, stdout, None, stderr)
+        cmd_paths = check_pipeline_commands([args])
+        if cmd_paths is None:
+            return None
+        return launch_command(args, cmd_paths[0], devnull, stdout, None, stderr)
+    finally:
+        os.close(devnull)
 
-    for command in pipeline:
-        if len(command.strip()) == 0:
-            print("mysh: syntax error: expected command after pipe", file=sys.stderr)
-            return
-    for command in pipeline:
-        cmd = command.split()[0]
+def check_pipeline_commands(pipeline):
+    """
+    Resolves the command of every stage, returning the paths or None if one cannot run.
+    """
+    cmd_paths = []
+    for args in pipeline:
+        cmd = args[0]
+        cmd_path = None
         if cmd not in BUILTIN_COMMANDS:
             cmd_path = search_cmd_path(cmd)
             if not cmd_path:
                 print(f"mysh: command not found: {cmd}", file=sys.stderr)
-                return
+                set_exit_statuses([127])
+                return None
             if not os.access(cmd_path, os.X_OK):
                 print(f"mysh: permission denied: {cmd}", file=sys.stderr)
-                return
-
-    for i, command in enumerate(pipeline):
-        command = command.replace('~', '/home') 
-        args = parse_command_expanded(command)
-        if i == 0:
-            if len(pipeline) == 1:
-                if not handle_builtin(args[0], args):
-                    pid = os.fork()
-                    if pid == 0:
-                        signal.signal(signal.SIGINT, signal.SIG_DFL)
-                        os.setpgid(0, 0)
-                        os.execvpe(args[0], args, os.environ)
-                    else:
-                        os.setpgid(pid, pid)
-                        os.wait()
-            else:
-                pipe_read, pipe_write = os.pipe()
-                pid = os.fork()
-                if pid == 0:
-                    signal.signal(signal.SIGINT, signal.SIG_DFL)
-                    os.setpgid(0, 0)
-                    os.dup2(pipe_write, 1)
-                    os.close(pipe_read)
-                    os.execvpe(args[0], args, os.environ)
-                else:
-                    os.setpgid(pid, pid)
-                    processes.append(pid)
-                    os.close(pipe_write)
-                    prev_pipe_read = pipe_read
-        else:
-            pipe_read, pipe_write = os.pipe() if i < len(pipeline) - 1 else (None, None)
-            pid = os.fork()
-            if pid == 0:
-                signal.signal(signal.SIGINT, signal.SIG_DFL)
-                os.setpgid(0, 0)
-                os.dup2(prev_pipe_read, 0)
-                if pipe_write is not None:
-                    os.dup2(pipe_write, 1)
-                os.close(prev_pipe_read)
-                if pipe_write is not None:
-                    os.close(pipe_write)
-                os.execvpe(args[0], args, os.environ)
-            else:
-                os.setpgid(pid, pid)
-                processes.append(pid)
-                os.close(prev_pipe_read)
-                if pipe_write is not None:
-                    os.close(pipe_write)
-                prev_pipe_read = pipe_read
-
-    for pid in processes:
-        os.waitpid(pid, 0)
-
-def execute_pipeline_command_and_capture_output(pipeline):
-    processes = []
-    prev_pipe_read = None
-    output = ""
-
-    for i, command in enumerate(pipeline):
-        command = command.replace('~', '/home') 
-        args = parse_command_expanded(command)
-        if i == 0:
-            if len(pipeline) == 1:
-                if not handle_builtin(args[0], args):
-                    pid = os.fork()
-                    if pid == 0:
-                        # default signal handler for SIGINT
-                        signal.signal(signal.SIGINT, signal.SIG_DFL)
-                        os.setpgid(0, 0)
-                        os.execvpe(args[0], args, os.environ)
-                    else:
-                        os.setpgid(pid, pid)
-                        os.wait()
-            else:
-                pipe_read, pipe_write = os.pipe()
-                pid = os.fork()
-                if pid == 0:
-                    # default signal handler for SIGINT
-                    signal.signal(signal.SIGINT, signal.SIG_DFL)
-                    os.setpgid(0, 0)
-                    os.dup2(pipe_write, 1)
-                    os.close(pipe_read)
-                    os.execvpe(args[0], args, os.environ)
-                else:
-                    os.setpgid(pid, pid)
-                    processes.append(pid)
-                    os.close(pipe_write)
-                    prev_pipe_read = pipe_read
-        elif i == len(pipeline) - 1:
-            pipe_read, pipe_write = os.pipe()
-            pid = os.fork()
-            if pid == 0:
-                # default signal handler for SIGINT
-                signal.signal(signal.SIGINT, signal.SIG_DFL)
-                os.setpgid(0, 0)
-                os.dup2(prev_pipe_read, 0)
-                os.dup2(pipe_write, 1)
-                os.close(prev_pipe_read)
-                os.close(pipe_write)
-                os.execvpe(args[0], args, os.environ)
-            else:
-                os.setpgid(pid, pid)
-                processes.append(pid)
-                # read from the last pipe
-                os.close(pipe_write)
-                with os.fdopen(pipe_read, 'r') as pipe:
-                    output = pipe.read()
+                set_exit_statuses([126])
+                return None
+        cmd_paths.append(cmd_path)
+    return cmd_paths
+
+def open_redirects(stage, opened):
+    """
+    Opens the files a stage redirects to, returning its redirects with an fd in place of each name.
+
+    Every fd opened is added to opened, also when a later open raises OSError.
+    The fds are not inheritable; spawn's file actions put them on 0/1/2 in the
+    child, so the command reads and writes the files directly.
+    """
+    redirects = []
+    for fd, op, target in expand_redirects(stage):
+        if op != DUPLICATE:
+            target = os.open(target, REDIRECT_FLAGS[op], 0o666)
+            opened.append(target)
+        redirects.append((fd, op, target))
+    return redirects
+
+def apply_redirects(redirects, fds, opened):
+    """
+    Applies opened redirects, in order, to fds: the [stdin, stdout, stderr] a stage would get.
+    """
+    for fd, op, target in redirects:
+        if op == DUPLICATE:
+            source = fds[target]
+            if source is None:
+                # a copy, so it still means the shell's fd after fd target is redirected
+                source = os.dup(target)
+                opened.append(source)
+            fds[fd] = source
         else:
-            pipe_read, pipe_write = os.pipe() if i < len(pipeline) - 1 else (None, None)
-            pid = os.fork()
-            if pid == 0:
-                # default signal handler for SIGINT
-                signal.signal(signal.SIGINT, signal.SIG_DFL)
-                os.setpgid(0, 0)
-                os.dup2(prev_pipe_read, 0)
-                if pipe_write is not None:
-                    os.dup2(pipe_write, 1)
-                os.close(prev_pipe_read)
-                if pipe_write is not None:
-                    os.close(pipe_write)
-                os.execvpe(args[0], args, os.environ)
-            else:
-                os.setpgid(pid, pid)
-                processes.append(pid)
-                os.close(prev_pipe_read)
-                if pipe_write is not None:
-                    os.close(pipe_write)
-                prev_pipe_read = pipe_read
-    for pid in processes:
-        os.waitpid(pid, 0)
-    return output
+            fds[fd] = target
+    return fds
 
-def execute_command_and_capture_output(command):
-    if '|' in command:
-        pipeline = split_by_pipe_op(command)
-        return execute_pipeline_command_and_capture_output(pipeline)
-    args = parse_command_expanded(command)
-    pipe_read, pipe_write = os.pipe()
-
-    if args[0] not in BUILTIN_COMMANDS and not search_cmd_path(args[0]):
-        cmd_path = search_cmd_path(args[0])
-        if not cmd_path:
-            print(f"mysh: command not found: {args[0]}", file=sys.stderr)
-            return ""
-        if not os.access(cmd_path, os.X_OK):
-            print(f"mysh: permission denied: {args[0]}", file=sys.stderr)
-            return ""
-
-    pid = os.fork()
-    if pid == 0:
-        # default signal handler for SIGINT
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
+def close_fds(fds):
+    for fd in fds:
+        os.close(fd)
+    fds.clear()
+
+def set_exit_statuses(statuses):
+    """
+    Records the status of every stage as ${PIPESTATUS} and the last one as $?.
+    """
+    SPECIAL_PARAMETERS['?'] = str(statuses[-1])
+    SPECIAL_PARAMETERS['PIPESTATUS'] = ' '.join(str(status) for status in statuses)
+
+def give_terminal_to(pgid):
+    """
+    Makes pgid the foreground process group, returning the terminal fd or None without one.
+    Does nothing unless the shell itself is in the foreground.
+    """
+    try:
+        terminal = os.open('/dev/tty', os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        if os.tcgetpgrp(terminal) != os.getpgrp():
+            raise OSError
+        os.tcsetpgrp(terminal, pgid)
+    except OSError:
+        os.close(terminal)
+        return None
+    return terminal
+
+def reclaim_terminal(terminal):
+    os.tcsetpgrp(terminal, os.getpgrp())
+    os.close(terminal)
+
+def run_builtin_with_output(args, output, stdin=None, stderr=None):
+    """
+    Runs a builtin in the shell with its stdout sent to a pipeline sink. Returns (status, captured).
+    """
+    if stdin is not None:
+        saved_stdin = os.dup(0)
+        os.dup2(stdin, 0)
         try:
-            os.setpgid(0, 0)
-        except Exception:
-            pass
+            return run_builtin_with_output(args, output, stderr=stderr)
+        finally:
+            os.dup2(saved_stdin, 0)
+            os.close(saved_stdin)
 
-        os.dup2(pipe_write, 1)
-        os.close(pipe_read)
+    if stderr is not None:
+        sys.stderr.flush()
+        saved_stderr = os.dup(2)
+        os.dup2(stderr, 2)
         try:
-            os.execvpe(args[0], args, os.environ)
-        except PermissionError:
-            os.write(pipe_write, f"mysh: permission denied: {args[0]}\n".encode())
-            sys.exit(1)
-        except Exception as e:
-            os.write(pipe_write, f"mysh: error: {e}\n".encode())
-            sys.exit(1)
+            return run_builtin_with_output(args, output)
+        finally:
+            sys.stderr.flush()
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stderr)
+
+    if output is None:
+        return run_builtin(args), None
+    if output == CAPTURE:
+        buffer = io.StringIO()
+        saved_stdout = sys.stdout
+        sys.stdout = buffer
+        try:
+            status = run_builtin(args)
+        finally:
+            sys.stdout = saved_stdout
+        return status, buffer.getvalue()
+
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    os.dup2(output, 1)
+    try:
+        return run_builtin(args), None
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+
+def job_command(pipeline):
+    return pipeline.text.strip().rstrip('&').rstrip()
+
+def run_pipeline(pipeline, output=None):
+    """
+    Runs a parsed pipeline with every stage in one process group and records its statuses.
+
+    output is where the last stage writes: None for the shell's stdout, an open
+    fd, or CAPTURE to collect it, in which case the captured text is returned.
+    Builtins never exec: a builtin last stage runs in the shell itself and any
+    other builtin stage runs in a forked child. Builtins that change shell
+    state only affect the shell when they are the whole pipeline.
+    """
+    tracing.counters["pipelines"] += 1
+    if not tracing.enabled:
+        return _run_pipeline(pipeline, output, None)
+    record = tracing.start("pipeline", job_command(pipeline))
+    try:
+        return _run_pipeline(pipeline, output, record)
+    finally:
+        tracing.finish(record, last_status())
+
+def argument_batches(fields):
+    """
+    Splits a command's arguments into lists that each fit ARG_MAX by dividing up the
+    word that expanded into the most arguments. Returns None when they already fit.
+    """
+    if len(fields) < 2:
+        return None
+    largest = max(range(1, len(fields)), key=lambda i: len(fields[i]))
+    prefix = [arg for field in fields[:largest] for arg in field]
+    suffix = [arg for field in fields[largest + 1:] for arg in field]
+    batches = split_arguments(prefix, fields[largest], suffix, argument_space())
+    return batches if len(batches) > 1 else None
+
+def finish_batch(job, max_jobs):
+    terminal = None
+    if job.grouped and max_jobs == 1:
+        terminal = give_terminal_to(job.pgid)
+    wait_for_job(job)
+    if terminal is not None:
+        reclaim_terminal(terminal)
+    if forget_deadline(job.pgid):
+        job.statuses[job.pgid] = TIMEOUT_STATUS
+
+def run_batches(batches, cmd_path, fds, max_jobs, command, record, seconds=None, limits=()):
+    """
+    Runs cmd_path once per argument list, like xargs, with at most max_jobs running
+    at a time. Each gets its own process group when the shell is interactive or
+    under a timeout, which covers all of them together.
+
+    ${PIPESTATUS} gets the status of every invocation and $? the first non-zero one.
+    """
+    deadline = None if seconds is None else time.monotonic() + seconds
+    grouped = interactive or seconds is not None
+    jobs = []
+    running = []
+    for args in batches:
+        if len(running) >= max_jobs:
+            finish_batch(running.pop(0), max_jobs)
+        pid = launch_command(args, cmd_path, fds[0], fds[1], 0 if grouped else None, fds[2], limits)
+        job = Job(pid, [pid], command, grouped=grouped)
+        jobs.append(job)
+        if pid:
+            tracing.counters["processes"] += 1
+            running.append(job)
+            if deadline is not None:
+                watch(pid, max(deadline - time.monotonic(), 0.001))
+    for job in running:
+        finish_batch(job, max_jobs)
+    if record is not None:
+        tracing.mark(record, "wait")
+        record["pids"] = [job.pgid for job in jobs]
+    statuses = [job.exit_statuses()[0] for job in jobs]
+    set_exit_statuses(statuses)
+    SPECIAL_PARAMETERS['?'] = str(next((status for status in statuses if status), 0))
+
+def _run_pipeline(pipeline, output, record):
+    if not pipeline.substitutions:
+        return _run_stages(pipeline, output, record)
+    previous = install_substitutions(run_substitutions(pipeline.substitutions))
+    if record is not None:
+        tracing.mark(record, "substitute")
+    try:
+        return _run_stages(pipeline, output, record)
+    finally:
+        install_substitutions(previous)
+
+def _run_stages(pipeline, output, record):
+    batch_jobs = 0
+    if len(pipeline.stages) == 1 and pipeline.stages[0].glob and output != CAPTURE and not pipeline.background:
+        batch_jobs = arg_batch_jobs()
+    if batch_jobs:
+        fields = expand_stage_fields(pipeline.stages[0])
+        stages = [[arg for field in fields for arg in field]]
     else:
+        stages = [expand_stage(stage) for stage in pipeline.stages]
+    seconds = None
+    limits = ()
+    if stages[0][0] in PREFIXES:
         try:
-            os.setpgid(pid, pid)
-        except Exception:
-            pass
-        except Exception as e:
-            print(f"mysh: error: {e}", file=sys.stderr)
+            seconds, limits, count = parse_prefixes(stages[0])
+        except ValueError as e:
+            print(f"mysh: {e}", file=sys.stderr)
+            set_exit_statuses([PREFIX_ERROR_STATUS])
+            return None
+        stages[0] = stages[0][count:]
+        if batch_jobs:
+            fields = fields[count:]
+    if record is not None:
+        tracing.mark(record, "expand")
+    cmd_paths = check_pipeline_commands(stages)
+    if record is not None:
+        tracing.mark(record, "lookup")
+    if cmd_paths is None:
+        return None
+    batches = None
+    if batch_jobs and cmd_paths[0] is not None:
+        batches = argument_batches(fields)
 
-        os.close(pipe_write)
-        os.waitpid(pid, 0)
+    capture = output == CAPTURE
+    background = pipeline.background and not capture
+    last = len(stages) - 1
+    last_cmd = stages[last][0]
+    # both raise on a bad setting, so they are read before any redirect is opened
+    limit = capture_limit() if capture else None
+    buffer_size = pipe_size() if last or capture else None
 
-    with os.fdopen(pipe_read, 'r') as pipe:
-        output = pipe.read()
-        if args[0] != 'cat':
-            output = output.rstrip()
+    opened = []
+    try:
+        stage_redirects = [open_redirects(stage, opened) if stage.redirects else None
+                           for stage in pipeline.stages]
+    except OSError as e:
+        close_fds(opened)
+        print(f"mysh: {e.filename}: {e.strerror}", file=sys.stderr)
+        set_exit_statuses([1])
+        return None
 
-    return output
+    if batches is not None:
+        fds = [None, output, None]
+        if stage_redirects[0]:
+            apply_redirects(stage_redirects[0], fds, opened)
+        sys.stdout.flush()
+        try:
+            run_batches(batches, cmd_paths[0], fds, batch_jobs, job_command(pipeline), record, seconds, limits)
+        finally:
+            close_fds(opened)
+        return None
 
+    # under a timeout or limit every stage is a child, which can be killed or limited
+    in_process = (not background and last_cmd in BUILTIN_COMMANDS
+                  and seconds is None and not limits
+                  and last_cmd not in STREAM_BUILTINS
+                  and not ((last or capture) and last_cmd in STATEFUL_BUILTINS)
+                  and not (capture and stage_redirects[last]))
+    # Without job control a foreground pipeline stays in the shell's process group,
+    # so it can read the terminal and Ctrl-C reaches it, as in sh. A timeout still
+    # needs a group of its own to kill.
+    grouped = interactive or background or seconds is not None
+    sys.stdout.flush()
+    pids = []
+    pgid = 0
+    terminal = None
+    prev_pipe_read = None
+    if background and not interactive:
+        # without job control a background job must not compete for the shell's input
+        prev_pipe_read = os.open(os.devnull, os.O_RDONLY)
 
-def main():
-    setup_signals()
+    for i, args in enumerate(stages):
+        if i == last and in_process:
+            break
+        if i < last or capture:
+            pipe_read, pipe_write = make_pipe(buffer_size)
+        else:
+            pipe_read, pipe_write = None, None
+        fds = [prev_pipe_read, pipe_write if pipe_write is not None else output, None]
+        if stage_redirects[i]:
+            apply_redirects(stage_redirects[i], fds, opened)
+        if args[0] in BUILTIN_COMMANDS:
+            pid = fork_call(lambda args=args: run_builtin(args), fds[0], fds[1],
+                            pgid if grouped else None, fds[2], limits)
+        else:
+            pid = launch_command(args, cmd_paths[i], fds[0], fds[1], pgid if grouped else None, fds[2], limits)
+        if pid and not pgid:
+            pgid = pid
+            if grouped and not capture and not background:
+                # hand the terminal over before the other stages start, and wake
+                # the first one if it already stopped on SIGTTIN reading it
+                terminal = give_terminal_to(pgid)
+                if terminal is not None:
+                    os.killpg(pgid, signal.SIGCONT)
+        if pid:
+            tracing.counters["processes"] += 1
+        pids.append(pid)
+        if prev_pipe_read is not None:
+            os.close(prev_pipe_read)
+        if pipe_write is not None:
+            os.close(pipe_write)
+        prev_pipe_read = pipe_read
+    if not in_process:
+        close_fds(opened)
 
-    env_vars = {}
-    parse_myshrc(env_vars)  
-    
-    while True:
+    job = Job(pgid, pids, job_command(pipeline), grouped=grouped)
+    if seconds is not None and pgid:
+        watch(pgid, seconds)
+    if record is not None:
+        tracing.mark(record, "spawn")
+        record["pids"] = pids
+    if background:
+        if pgid:
+            add_job(job)
+            SPECIAL_PARAMETERS['!'] = str(pgid)
+            if interactive:
+                print(f"[{job.job_id}] {pgid}")
+        set_exit_statuses([0])
+        return None
+
+    captured = None
+    status = None
+    try:
+        if in_process:
+            fds = [prev_pipe_read, output, None]
+            if stage_redirects[last]:
+                apply_redirects(stage_redirects[last], fds, opened)
+            status, captured = run_builtin_with_output(stages[last], fds[1], fds[0], fds[2])
+            if limit is not None and len(captured.encode(errors='surrogateescape')) > limit:
+                raise CaptureLimitError(f"output exceeds {limit} bytes")
+        elif capture:
+            captured = read_output(prev_pipe_read, limit)
+    finally:
+        if in_process and prev_pipe_read is not None:
+            # upstream stages get SIGPIPE, as they would writing to an exited command
+            os.close(prev_pipe_read)
+        close_fds(opened)
+        if pgid:
+            wait_for_job(job, untraced=interactive)
+        if terminal is not None:
+            reclaim_terminal(terminal)
+        if record is not None:
+            tracing.mark(record, "wait")
+            record["children"] = [tracing.child_usage(pid, args[0], job.statuses.get(pid), job.usage.get(pid))
+                                  for pid, args in zip(pids, stages) if pid]
+    statuses = job.exit_statuses()
+    if job.state == STOPPED:
+        add_job(job)
+        print(f"\n[{job.job_id}]+  {STOPPED:<24}{job.command}")
+        statuses[-1] = 128 + signal.SIGTSTP
+    elif seconds is not None and pgid and forget_deadline(pgid):
+        statuses[-1] = TIMEOUT_STATUS
+        if record is not None:
+            record["timed_out"] = True
+    if in_process:
+        statuses.append(status)
+    set_exit_statuses(statuses)
+    return captured
+
+def should_run(operator):
+    """
+    True when the pipeline that operator puts next in a list runs, given the status so far.
+    """
+    if operator == AND_LIST:
+        return last_status() == 0
+    if operator == OR_LIST:
+        return last_status() != 0
+    return True
+
+def run_list(pipeline, output=None, fail_fast=False):
+    """
+    Runs a parsed line: a pipeline and the pipelines chained on to it with ;, &, &&
+    and ||, all from the one parse and without going back to the read loop.
+
+    A pipeline after && or || is skipped unless the exit status of the last one
+    that ran (its last stage) says it should run. With fail_fast, the list stops
+    at a failure that is not on the left of an && or ||, as with sh -e.
+    With output CAPTURE, returns the captured output of every pipeline run.
+    """
+    global status_is_condition
+    captured = []
+    while pipeline is not None:
         try:
-            user_input = input(os.getenv('PROMPT', '>> '))
-            if not user_input.strip():
-                continue
+            output_text = run_pipeline(pipeline, output)
+        finally:
+            clear_glob_cache()
+        if output_text:
+            captured.append(output_text)
+        following = pipeline.then
+        status_is_condition = following is not None and following[0] in (AND_LIST, OR_LIST)
+        if fail_fast and last_status() != 0 and not status_is_condition:
+            break
+        pipeline = None
+        while following is not None:
+            operator, candidate = following
+            if should_run(operator):
+                pipeline = candidate
+                break
+            following = candidate.then
+    return ''.join(captured)
+
+def execute_pipeline(pipeline):
+    run_list(pipeline)
+
+def execute_command_and_capture_output(command):
+    pipeline = parse_line(command)
+    if not pipeline.stages:
+        return ""
+    output = run_list(pipeline, CAPTURE)
+    return output.rstrip('\n') if output else ""
+
+
+def runs_in_process(command):
+    """
+    True when command can be captured by the shell itself without changing its state.
+    """
+    for pipeline in list_pipelines(parse_line(command)):
+        stages = pipeline.stages
+        if len(stages) == 1 and stages[0].words[0].literal in STATEFUL_BUILTINS:
+            return False
+    return True
 
+def direct_command(command):
+    """
+    Returns (args, cmd_path) when command is a single external command that can be
+    spawned straight from the shell, or None.
+    """
+    pipeline = parse_line(command)
+    if (len(pipeline.stages) != 1 or pipeline.background or pipeline.then
+            or pipeline.substitutions or pipeline.stages[0].redirects):
+        return None
+    args = expand_stage(pipeline.stages[0])
+    if args[0] in BUILTIN_COMMANDS:
+        return None
+    cmd_path = search_cmd_path(args[0])
+    if not cmd_path or not os.access(cmd_path, os.X_OK):
+        return None
+    return args, cmd_path
+
+def run_substitution(command):
+    """
+    Body of the forked shell that runs one $(...) command.
+    """
+    global interactive
+    interactive = False
+    return run_line(command)
+
+def run_substitutions(commands):
+    """
+    Runs the $(...) commands of a line and returns {command: output}, without the
+    output's trailing newlines.
+
+    A lone command that leaves the shell's state alone is captured in the shell
+    itself. Otherwise they all run at the same time, a plain external command
+    spawned directly and anything else in a forked copy of the shell, and their
+    outputs are read together as bytes, so a line costs about as much as its
+    slowest substitution.
+    """
+    if len(commands) == 1 and runs_in_process(commands[0]):
+        # the words around it still see the $? from before the line, as in a forked substitution
+        saved = SPECIAL_PARAMETERS['?'], SPECIAL_PARAMETERS['PIPESTATUS']
+        try:
+            return {commands[0]: execute_command_and_capture_output(commands[0])}
+        finally:
+            SPECIAL_PARAMETERS['?'], SPECIAL_PARAMETERS['PIPESTATUS'] = saved
+    limit = capture_limit()
+    pids = []
+    read_fds = []
+    try:
+        for command in commands:
+            read_fd, write_fd = make_pipe()
+            read_fds.append(read_fd)
             try:
-                pipeline = split_by_pipe_op(user_input)
-                error = False
-                for command in pipeline:
-                    command_strs = shlex.shlex(command, posix=True)
-                    command_strs.whitespace_split = True
-                    command_strs.escapedquotes = '"' + "'"
-                    command_strs = list(command_strs)
-                    for command_str in command_strs:
-                        if expand_variables(command_str) == None:
-                            error = True
-                            break
-                    if error:
-                        break
-                if error:
-                    continue
-            except Exception:
-                print("mysh: syntax error: unterminated quote", file=sys.stderr)
-                continue
+                direct = direct_command(command)
+                if direct is not None:
+                    pid = launch_command(direct[0], direct[1], None, write_fd, None)
+                else:
+                    pid = fork_call(lambda command=command: run_substitution(command), None, write_fd, None)
+            finally:
+                os.close(write_fd)
+            if pid:
+                pids.append(pid)
+                tracing.counters["processes"] += 1
+        # read_outputs() closes the fds it is given, also when it raises
+        fds, read_fds = read_fds, []
+        outputs = read_outputs(fds, limit)
+    finally:
+        close_fds(read_fds)
+        for pid in pids:
+            os.waitpid(pid, 0)
+    return {command: output.rstrip('\n') for command, output in zip(commands, outputs)}
 
-            pipeline = split_by_pipe_op(user_input)
+set_substitution_runner(run_substitutions)
 
-            if len(pipeline) > 1:
-                setup_signals_pipe()
-                execute_pipeline(pipeline)
-                setup_signals()
-            else:
-                args = parse_command_expanded(user_input)
-                if not handle_builtin(args[0], args):
-                    cmd_path = search_cmd_path(args[0])
-                    if not cmd_path:
-                        print(f"mysh: command not found: {args[0]}", file=sys.stderr)
-                    elif not os.access(cmd_path, os.X_OK):
-                        print(f"mysh: permission denied: {args[0]}", file=sys.stderr)
-                    else:
-                        pid = os.fork()
-                        if pid == 0:
-                            # default signal handler for SIGINT
-                            signal.signal(signal.SIGINT, signal.SIG_DFL)
-                            os.setpgid(0, 0)
-                            os.execvpe(args[0], args, os.environ)
-                        else:
-                            try:
-                                os.setpgid(pid, pid)
-                            except Exception:
-                                pass
-                            pgid = os.getpgid(pid)
-                            terminal = os.open('/dev/tty', os.O_RDWR)
-                            os.tcsetpgrp(terminal, pgid)
-                            os.wait()
-                            pgrp = os.getpgrp()
-                            os.tcsetpgrp(terminal, pgrp)
-                            os.close(terminal)
+def last_status():
+    return int(SPECIAL_PARAMETERS['?'])
+
+def run_line(user_input, fail_fast=False):
+    """
+    Parses and runs one line of input, returning its exit status.
+    """
+    if not user_input.strip():
+        return 0
+    tracing.counters["lines"] += 1
+    if not tracing.enabled:
+        return _run_line(user_input, None, fail_fast)
+    record = tracing.start("line", user_input)
+    try:
+        return _run_line(user_input, record, fail_fast)
+    finally:
+        tracing.finish(record, last_status())
+
+def _run_line(user_input, record, fail_fast):
+    global status_is_condition
+    status_is_condition = False
+    try:
+        pipeline = parse_line(user_input)
+    except MyshSyntaxError as e:
+        print(f"mysh: syntax error: {e}", file=sys.stderr)
+        set_exit_statuses([2])
+        return 2
+    if not pipeline.stages:
+        # nothing but a comment
+        return 0
+    if record is not None:
+        tracing.mark(record, "parse")
+
+    try:
+        run_list(pipeline, fail_fast=fail_fast)
+    except Exception as e:
+        print(f"mysh: error: {str(e)}", file=sys.stderr)
+        set_exit_statuses([1])
+    return last_status()
+
+def run_interactive():
+    history = history_store()
+    load_readline_history(history)
+    while True:
+        try:
+            for job in finished_jobs():
+                print(f"[{job.job_id}]  {'Done':<24}{job.command}")
+            user_input = input(get_variable('PROMPT', '>> '))
+            try:
+                history.append(user_input)
+            except OSError:
+                pass
+            run_line(user_input)
         except EOFError:
             print()
             break
         except KeyboardInterrupt:
             print()
             continue
-        except Exception as e:
-            print(f"mysh: error: {str(e)}", file=sys.stderr)
+    return 0
 
-if __name__ == "__main__":
-    main()
+def run_batch(lines, fail_fast=False):
+    """
+    Runs lines of a script without prompts, stopping at the first failure when fail_fast is set.
+    """
+    status = 0
+    for line in lines:
+        status = run_line(line.rstrip('\n'), fail_fast)
+        sys.stdout.flush()
+        if fail_fast and status != 0 and not status_is_condition:
+            break
+    return status
+
+def open_batch_input(path_or_fd):
+    return open(path_or_fd, 'r', buffering=BATCH_BUFFER_SIZE, errors='surrogateescape',
+                closefd=not isinstance(path_or_fd, int))
+
+def report_startup_profile(phases):
+    """
+    Prints how long each startup phase took, measured from when mysh.py began importing.
+    """
+    for name, seconds in phases:
+        print(f"mysh: startup: {name}: {seconds * 1e3:.2f} ms", file=sys.stderr)
 
+def parse_arguments(argv):
+    options = {"command": None, "script": None, "interactive": False, "fail_fast": False,
+               "startup_profile": False, "trace": None, "serve": None, "connect": None,
+               "workers": os.cpu_count() or 1}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '-c':
+            if i + 1 >= len(argv):
+                print("mysh: -c: option requires an argument", file=sys.stderr)
+                sys.exit(2)
+            options["command"] = argv[i + 1]
+            i += 1
+        elif arg == '-i':
+            options["interactive"] = True
+        elif arg in ('-e', '--fail-fast'):
+            options["fail_fast"] = True
+        elif arg == '--startup-profile':
+            options["startup_profile"] = True
+        elif arg in ('--trace', '--serve', '--connect', '--workers'):
+            if i + 1 >= len(argv):
+                print(f"mysh: {arg}: option requires an argument", file=sys.stderr)
+                sys.exit(2)
+            options[arg[2:]] = argv[i + 1]
+            i += 1
+        elif arg.startswith('-') and arg != '-':
+            print(f"mysh: invalid option: {arg}", file=sys.stderr)
+            print(USAGE, file=sys.stderr)
+            sys.exit(2)
+        else:
+            options["script"] = arg
+            break
+        i += 1
+    if not str(options["workers"]).isdigit() or int(options["workers"]) < 1:
+        print(f"mysh: --workers: expected a positive number: {options['workers']}", file=sys.stderr)
+        sys.exit(2)
+    options["workers"] = int(options["workers"])
+    return options
 
+def run_source(command, script, fail_fast):
+    """
+    Runs a batch from a -c command, a script path, or stdin when both are None.
+    """
+    if command is not None:
+        return run_batch(command.splitlines(), fail_fast)
+    if script is not None and script != '-':
+        try:
+            source = open_batch_input(script)
+        except OSError as e:
+            print(f"mysh: {script}: {e.strerror}", file=sys.stderr)
+            sys.exit(127)
+        with source:
+            return run_batch(source, fail_fast)
+    return run_batch(open_batch_input(sys.stdin.fileno()), fail_fast)
+
+def run_session(request, fds):
+    """
+    Runs one --connect client's batch in a server worker, on the client's stdin,
+    stdout and stderr (fds) and in its working directory.
+    """
+    for target, fd in enumerate(fds):
+        if fd != target:
+            os.dup2(fd, target)
+            os.close(fd)
+    setup_signals()
+    os.chdir(request["cwd"])
+    set_variable("PWD", request["cwd"], export=True)
+    return run_source(request["command"], request["script"], request["fail_fast"])
+
+def connect_to_server(options):
+    from server import connect, ServerError
+    script = options["script"]
+    if script is not None and script != '-':
+        script = os.path.abspath(script)
+    request = {"cwd": os.environ.get("PWD") or os.getcwd(), "command": options["command"],
+               "script": script, "fail_fast": options["fail_fast"]}
+    try:
+        return connect(options["connect"], request)
+    except (OSError, ServerError) as e:
+        print(f"mysh: {options['connect']}: {e.strerror if isinstance(e, OSError) else e}", file=sys.stderr)
+        return 1
+
+def warm_up():
+    """
+    Does the lazy first-use work (imports, compiled patterns) that every server worker would otherwise repeat.
+    """
+    parse_line("warm 'up' | $warm > ~/up")
+    import selectors
+
+def main():
+    global interactive
+    options = parse_arguments(sys.argv[1:])
+    if options["connect"] is not None:
+        sys.exit(connect_to_server(options))
+    phase_began = time.perf_counter()
+    setup_signals()
+    signals_done = time.perf_counter()
+
+    env_vars = {}
+    rc_source = parse_myshrc(env_vars)
+    myshrc_done = time.perf_counter()
+
+    trace_path = options["trace"] or get_variable("MYSH_TRACE")
+    if trace_path:
+        try:
+            tracing.start_trace(trace_path)
+        except OSError as e:
+            print(f"mysh: {trace_path}: {e.strerror}", file=sys.stderr)
+
+    if options["startup_profile"]:
+        report_startup_profile([
+            ("imports", _imports_done - _startup_began),
+            ("arguments", phase_began - _imports_done),
+            ("signals", signals_done - phase_began),
+            (f"myshrc ({rc_source})", myshrc_done - signals_done),
+            ("total", myshrc_done - _startup_began),
+        ])
+
+    if options["serve"] is not None:
+        from server import serve, ServerError
+        warm_up()
+        # the server itself forks workers and must not reap them through reap_jobs
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        try:
+            serve(options["serve"], run_session, options["workers"])
+        except (OSError, ServerError) as e:
+            print(f"mysh: {options['serve']}: {e.strerror if isinstance(e, OSError) else e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    if options["command"] is None and options["script"] is None and (options["interactive"] or sys.stdin.isatty()):
+        interactive = True
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTSTP, signal.SIG_IGN)
+        status = run_interactive()
+    else:
+        # without job control Ctrl-C reaches the foreground children and the shell alike, as in sh
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        status = run_source(options["command"], options["script"], options["fail_fast"])
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import sys
+
+from jobs import exit_status
+
+READ_CHUNK_SIZE = 1 << 16
+
+
+def substitute(template, arg):
+    """
+    Builds one job's argv: {} in the template is replaced by arg, or arg is appended.
+    """
+    if any('{}' in word for word in template):
+        return [word.replace('{}', arg) for word in template]
+    return template + [arg]
+
+
+class _Task:
+    def __init__(self, index, argv):
+        self.index = index
+        self.argv = argv
+        self.pid = None
+        self.status = None
+        self.output = {'out': bytearray(), 'err': bytearray()}
+        self.open_fds = 0
+
+
+def _emit(task):
+    if task.output['out']:
+        sys.stdout.write(task.output['out'].decode(errors='surrogateescape'))
+        sys.stdout.flush()
+    if task.output['err']:
+        sys.stderr.write(task.output['err'].decode(errors='surrogateescape'))
+        sys.stderr.flush()
+
+
+def run_parallel(template, inputs, launch, max_jobs, keep_order=False, halt=False):
+    """
+    Runs template once per input with at most max_jobs running at a time.
+
+    launch(argv, stdout_fd, stderr_fd) starts one job and returns its pid or
+    None. Each job's stdout and stderr are buffered and written out whole once
+    the job exits, in input order when keep_order is set and otherwise in order
+    of completion. With halt, no new jobs start after the first failure.
+    Returns the exit statuses of the jobs that ran, in input order.
+    """
+    import selectors
+    selector = selectors.DefaultSelector()
+    pending = iter(enumerate(inputs))
+    running = {}
+    finished = {}
+    statuses = {}
+    next_to_emit = 0
+    halted = False
+
+    def finish(task):
+        nonlocal next_to_emit, halted
+        statuses[task.index] = task.status
+        if task.status != 0 and halt:
+            halted = True
+        if not keep_order:
+            _emit(task)
+            return
+        finished[task.index] = task
+        while next_to_emit in finished:
+            _emit(finished.pop(next_to_emit))
+            next_to_emit += 1
+
+    try:
+        while True:
+            while not halted and len(running) < max_jobs:
+                item = next(pending, None)
+                if item is None:
+                    break
+                task = _Task(item[0], substitute(template, item[1]))
+                out_read, out_write = os.pipe()
+                err_read, err_write = os.pipe()
+                try:
+                    task.pid = launch(task.argv, out_write, err_write)
+                finally:
+                    os.close(out_write)
+                    os.close(err_write)
+                if task.pid is None:
+                    os.close(out_read)
+                    os.close(err_read)
+                    task.status = 127
+                    finish(task)
+                    continue
+                selector.register(out_read, selectors.EVENT_READ, (task, 'out'))
+                selector.register(err_read, selectors.EVENT_READ, (task, 'err'))
+                task.open_fds = 2
+                running[task.pid] = task
+
+            if not running:
+                break
+
+            for key, _ in selector.select():
+                task, stream = key.data
+                data = os.read(key.fd, READ_CHUNK_SIZE)
+                if data:
+                    task.output[stream] += data
+                    continue
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                task.open_fds -= 1
+                if task.open_fds == 0:
+                    _, wait_status = os.waitpid(task.pid, 0)
+                    task.status = exit_status(wait_status)
+                    del running[task.pid]
+                    finish(task)
+    finally:
+        for key in list(selector.get_map().values()):
+            os.close(key.fd)
+        selector.close()
+
+    # jobs skipped by --halt leave gaps; flush whatever ordered output is left
+    for index in sorted(finished):
+        _emit(finished[index])
+    return [statuses[index] for index in sorted(statuses)]
@@ -1,142 +1,1066 @@
-import re
-import shlex
 import os
 import sys
-import json
+import marshal
 
-_PIPE_REGEX_PATTERN = re.compile(
-    r"\\\""     # Match escaped double quotes
-    r"|\\'"     # OR match escaped single quotes
-    r"|\"(?:\\\"|[^\"])*\""  # OR match strings in double quotes
-    r"|'(?:\\'|[^'])*'"      # OR match strings in single quotes
-    r"|(\|)"    # Match unquoted pipe operator and capture
-)
+from variables import get_variable, set_variable
+from cachefiles import cache_path, write_atomically
 
-def split_by_pipe_op(cmd_str: str) -> list[str]:
+# re and json are only imported when first needed, to keep startup cheap.
+_plain_run_pattern = None
+_WORD_BREAKS = ' \t\n\r\f\v|&;<>'
+# Lines without any of these (and only ASCII) are plain words split on whitespace.
+_SPECIAL_CHARS = frozenset('|&;<>\'"\\$~*?[#\x1c\x1d\x1e\x1f')
+_GLOB_CHARS = frozenset('*?[')
+_DQUOTE_ESCAPES = '$`"\\\n'
+
+# Kinds of word parts. Each part is a (kind, value, quoted) tuple. The value of
+# a DEFAULT part is a (name, default parts) pair; for the others it is a string.
+LITERAL = 'lit'
+VARIABLE = 'var'        # $NAME, ${NAME}, $?
+DEFAULT = 'default'     # ${NAME:-default}
+LENGTH = 'len'          # ${#NAME}
+TILDE = 'tilde'
+COMMAND = 'cmd'         # $(command), the value is the command's text
+
+# Operators joining the pipelines of a list. A pipeline after AND_LIST only runs
+# when the status so far is 0, one after OR_LIST only when it is not.
+SEQUENCE = ';'
+BACKGROUND = '&'
+AND_LIST = '&&'
+OR_LIST = '||'
+
+# Redirection operators. Each redirect is a (fd, operator, target) tuple where
+# target is a Word naming the file, or the fd number to copy for DUPLICATE.
+READ = '<'
+WRITE = '>'
+APPEND = '>>'
+DUPLICATE = '>&'
+
+PARSE_CACHE_SIZE = 512
+_parse_cache = {}
+_template_cache = {}
+_matcher_cache = {}
+
+# path -> listing for every directory a glob has listed since the line started
+_listing_cache = {}
+_subdirectory_cache = {}
+
+RC_CACHE_FORMAT = 1
+
+# Parameters set by the shell itself, such as $? and ${PIPESTATUS}. They are
+# looked up before shell and environment variables and never passed on to children.
+# ${PARALLEL_STATUS} holds the job statuses of the last parallel builtin.
+SPECIAL_PARAMETERS = {'?': '0', '!': '', 'PIPESTATUS': '0', 'PARALLEL_STATUS': ''}
+
+# Outputs of the $(...) commands being expanded, run ahead of expansion so that
+# all of a line's substitutions run at once, and the function that runs them.
+_substitution_outputs = {}
+_substitution_runner = None
+
+
+class MyshSyntaxError(Exception):
+    pass
+
+
+class Word:
+    __slots__ = ('parts', 'quotes', 'literal', 'glob')
+
+    def __init__(self, parts, quotes, literal, glob=False):
+        self.parts = parts
+        self.quotes = quotes      # (start, end) offsets of every quoted region in the line
+        self.literal = literal    # the word itself when it has no expansion sites, else None
+        self.glob = glob          # True when an unquoted *, ? or [ makes it a pattern
+
+
+class Stage:
+    __slots__ = ('words', 'text', 'redirects', 'glob')
+
+    def __init__(self, words, text, redirects=()):
+        self.words = words
+        self.text = text
+        self.redirects = redirects
+        self.glob = any(word.glob for word in words)
+
+
+class Pipeline:
+    __slots__ = ('stages', 'text', 'background', 'substitutions', 'then')
+
+    def __init__(self, stages, text, background=False, then=None):
+        self.stages = stages
+        self.text = text
+        self.background = background
+        self.then = then          # (operator, Pipeline) for the rest of a list, or None
+        # the distinct $(...) commands in the words and redirects, in order
+        self.substitutions = tuple(dict.fromkeys(
+            part[1]
+            for stage in stages
+            for word in stage.words + tuple(target for _, op, target in stage.redirects if op != DUPLICATE)
+            for part in word.parts if part[0] == COMMAND))
+
+
+def is_valid_name(name):
     """
-    Splits the command string by unquoted pipe operators.
+    True for names matching [A-Za-z_][A-Za-z0-9_]*.
     """
-    split_str_indexes = []
+    return name.isascii() and name.isidentifier()
 
-    for match in _PIPE_REGEX_PATTERN.finditer(cmd_str):
-        if match.group(1) is not None:
-            split_str_indexes.append(match.start())
 
-    if not split_str_indexes:
-        return [cmd_str]
+def _plain_run():
+    """
+    Compiles the pattern for runs of characters that never need a closer look from the tokenizer.
+    """
+    global _plain_run_pattern
+    if _plain_run_pattern is None:
+        import re
+        _plain_run_pattern = re.compile(r'[^\s|&;<>\'"\\$~]+')
+    return _plain_run_pattern
 
-    split_str = []
-    prev_index = 0
-    for next_index in split_str_indexes:
-        cmd_str_slice = cmd_str[prev_index:next_index]
-        split_str.append(cmd_str_slice)
-        prev_index = next_index + 1
 
-    cmd_str_slice = cmd_str[prev_index:]
-    split_str.append(cmd_str_slice)
+def _make_word(parts, quotes):
+    literal = None
+    if all(kind == LITERAL for kind, _, _ in parts):
+        literal = ''.join(value for _, value, _ in parts)
+    glob = any(kind == LITERAL and not quoted and not _GLOB_CHARS.isdisjoint(value)
+               for kind, value, quoted in parts)
+    return Word(tuple(parts), tuple(quotes), literal, glob)
 
-    return split_str
 
-def parse_myshrc(env_vars):
+def tokenize(line: str) -> Pipeline:
     """
-    Parses the .myshrc file to set environment variables.
+    Scans a line once into a pipeline of stages and words, raising MyshSyntaxError on bad input.
+
+    A line holding a list (pipelines joined by ;, &, && or ||) becomes its first
+    pipeline, with the rest chained on through Pipeline.then.
     """
-    myshrc_path = os.path.expanduser("~/.myshrc")
-    if os.getenv("MYSHDOTDIR"):
-        myshrc_path = os.path.join(os.getenv("MYSHDOTDIR"), ".myshrc")
-    
-    if os.path.exists(myshrc_path):
-        try:
-            with open(myshrc_path, "r") as f:
-                data = json.load(f)
-                for key, value in data.items():
-                    if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', key):
-                        print(f"mysh: .myshrc: {key}: invalid characters for variable name", file=sys.stderr)
-                    elif not isinstance(value, str):
-                        print(f"mysh: .myshrc: {key}: not a string", file=sys.stderr)
-                    else:
-                        expanded_value = os.path.expandvars(value)
-                        os.environ[key] = expanded_value
-                        env_vars[key] = expanded_value
-        except json.JSONDecodeError:
-            print("mysh: invalid JSON format for .myshrc", file=sys.stderr)
-    
-    if "PROMPT" not in os.environ:
-        os.environ["PROMPT"] = ">> "
-    if "MYSH_VERSION" not in os.environ:
-        os.environ["MYSH_VERSION"] = "1.0"
-    if "PATH" not in os.environ:
-        os.environ["PATH"] = os.defpath
+    if line.isascii() and _SPECIAL_CHARS.isdisjoint(line):
+        words = tuple(Word((), (), word) for word in line.split())
+        return Pipeline((Stage(words, line),) if words else (), line)
+
+    plain_run = _plain_run()
+    stages = []
+    words = []
+    redirects = []
+    redirect = None
+    parts = []
+    quotes = []
+    buf = []
+    buf_quoted = False
+    in_word = False
+    stage_start = 0
+    list_start = 0
+    pipelines = []
+    i = 0
+    n = len(line)
+
+    while i < n:
+        char = line[i]
+
+        if char in _WORD_BREAKS:
+            # a bare 0, 1 or 2 right before > or < is the fd to redirect, not an argument
+            fd = None
+            if char in '<>' and in_word and not parts and not quotes and buf in (['0'], ['1'], ['2']):
+                fd = int(buf[0])
+                buf = []
+                in_word = False
+            if buf:
+                parts.append((LITERAL, ''.join(buf), buf_quoted))
+                buf = []
+            if in_word:
+                if redirect is not None:
+                    redirects.append(redirect + (_make_word(parts, quotes),))
+                    redirect = None
+                else:
+                    words.append(_make_word(parts, quotes))
+                parts = []
+                quotes = []
+                in_word = False
+            if redirect is not None and char not in ' \t\n\r\f\v':
+                raise MyshSyntaxError(f"expected file after '{redirect[1]}'")
+            if char in '<>':
+                i = _scan_redirect(line, i, fd, redirects)
+                if redirects and redirects[-1][1] == DUPLICATE:
+                    continue
+                redirect = redirects.pop()
+                continue
+            if char == '|' and not line.startswith(OR_LIST, i):
+                if not words:
+                    if stages:
+                        raise MyshSyntaxError("expected command after pipe")
+                    raise MyshSyntaxError("expected command before '|'")
+                stages.append(Stage(tuple(words), line[stage_start:i], tuple(redirects)))
+                words = []
+                redirects = []
+                stage_start = i + 1
+            elif char in '|&;':
+                operator = line[i:i + 2] if line.startswith((AND_LIST, OR_LIST), i) else char
+                if not words:
+                    if stages:
+                        raise MyshSyntaxError("expected command after pipe")
+                    raise MyshSyntaxError(f"expected command before '{operator}'")
+                stages.append(Stage(tuple(words), line[stage_start:i], tuple(redirects)))
+                pipelines.append((Pipeline(tuple(stages), line[list_start:i], operator == BACKGROUND), operator))
+                stages = []
+                words = []
+                redirects = []
+                i += len(operator)
+                stage_start = list_start = i
+                continue
+            i += 1
+            continue
+
+        if char == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                raise MyshSyntaxError("unterminated quote")
+            if buf and not buf_quoted:
+                parts.append((LITERAL, ''.join(buf), buf_quoted))
+                buf = []
+            buf.append(line[i + 1:end])
+            buf_quoted = True
+            quotes.append((i, end + 1))
+            in_word = True
+            i = end + 1
+            continue
 
-def parse_command(command_str: str) -> list[str]:
+        if char == '"':
+            if buf and not buf_quoted:
+                parts.append((LITERAL, ''.join(buf), buf_quoted))
+                buf = []
+            buf_quoted = True
+            in_word = True
+            quote_start = i
+            i += 1
+            while True:
+                if i >= n:
+                    raise MyshSyntaxError("unterminated quote")
+                char = line[i]
+                if char == '"':
+                    break
+                if char == '\\' and i + 1 < n and line[i + 1] in _DQUOTE_ESCAPES:
+                    buf.append(line[i + 1])
+                    i += 2
+                elif char == '$':
+                    i = _scan_dollar(line, i, parts, buf, True)
+                    buf = []
+                else:
+                    buf.append(char)
+                    i += 1
+            quotes.append((quote_start, i + 1))
+            i += 1
+            continue
+
+        if char == '\\':
+            if buf and not buf_quoted:
+                parts.append((LITERAL, ''.join(buf), buf_quoted))
+                buf = []
+            buf.append(line[i + 1] if i + 1 < n else char)
+            buf_quoted = True
+            in_word = True
+            i += 2
+            continue
+
+        if buf and buf_quoted:
+            parts.append((LITERAL, ''.join(buf), buf_quoted))
+            buf = []
+        buf_quoted = False
+
+        if char == '$':
+            i = _scan_dollar(line, i, parts, buf, False)
+            buf = []
+            in_word = True
+            continue
+
+        if char == '#' and not in_word:
+            # a comment, such as a script's #! line, runs to the end of the line
+            end = line.find('\n', i)
+            i = n if end == -1 else end
+            continue
+
+        if char == '~' and not in_word and (i + 1 == n or line[i + 1] == '/' or line[i + 1] in _WORD_BREAKS):
+            parts.append((TILDE, '~', False))
+            in_word = True
+            i += 1
+            continue
+
+        match = plain_run.match(line, i)
+        if match:
+            buf.append(match.group())
+            i = match.end()
+        else:
+            buf.append(char)
+            i += 1
+        in_word = True
+
+    if buf:
+        parts.append((LITERAL, ''.join(buf), buf_quoted))
+    if in_word:
+        if redirect is not None:
+            redirects.append(redirect + (_make_word(parts, quotes),))
+            redirect = None
+        else:
+            words.append(_make_word(parts, quotes))
+    if redirect is not None:
+        raise MyshSyntaxError(f"expected file after '{redirect[1]}'")
+    if words:
+        stages.append(Stage(tuple(words), line[stage_start:n], tuple(redirects)))
+    elif redirects:
+        raise MyshSyntaxError("expected command before redirection")
+    elif stages:
+        raise MyshSyntaxError("expected command after pipe")
+    elif pipelines and pipelines[-1][1] in (AND_LIST, OR_LIST):
+        raise MyshSyntaxError(f"expected command after '{pipelines[-1][1]}'")
+
+    if not pipelines:
+        return Pipeline(tuple(stages), line)
+    # a trailing ; or & leaves nothing to chain on
+    pipeline = Pipeline(tuple(stages), line[list_start:n]) if stages else None
+    for previous, operator in reversed(pipelines):
+        previous.then = None if pipeline is None else (operator, pipeline)
+        pipeline = previous
+    return pipeline
+
+
+def list_pipelines(pipeline: Pipeline):
     """
-    Parses a command string into a list of arguments.
+    Yields a pipeline and every pipeline chained on to it by a list.
     """
-    return shlex.split(command_str, posix=True)
+    while pipeline is not None:
+        yield pipeline
+        pipeline = pipeline.then[1] if pipeline.then else None
 
-def expand_variables(cmd_str: str) -> str:
-    result = []
-    escaped = False
-    in_single_quote = False
-    in_double_quote = False
 
+def _scan_redirect(line, i, fd, redirects):
+    """
+    Reads the redirection operator at line[i], appending (fd, operator) to redirects,
+    or the whole redirect for >&N. Returns the index after the operator.
+    """
+    if line[i] == '<':
+        redirects.append((0 if fd is None else fd, READ))
+        return i + 1
+    fd = 1 if fd is None else fd
+    if line.startswith('>>', i):
+        redirects.append((fd, APPEND))
+        return i + 2
+    if line.startswith('>&', i):
+        target = line[i + 2:i + 3]
+        if target not in ('1', '2') or not (i + 3 == len(line) or line[i + 3] in _WORD_BREAKS):
+            raise MyshSyntaxError("expected 1 or 2 after '>&'")
+        redirects.append((fd, DUPLICATE, int(target)))
+        return i + 3
+    redirects.append((fd, WRITE))
+    return i + 1
+
+
+def _is_name_char(char):
+    return char == '_' or (char.isascii() and char.isalnum())
+
+
+def _braced_part(body, quoted):
+    """
+    Compiles the inside of ${...} into a word part.
+    """
+    if body.startswith('#') and len(body) > 1:
+        name = body[1:]
+        part = (LENGTH, name, quoted)
+    elif ':-' in body:
+        name, _, default = body.partition(':-')
+        part = (DEFAULT, (name, _default_parts(default, quoted)), quoted)
+    else:
+        name = body
+        part = (VARIABLE, name, quoted)
+    if name not in SPECIAL_PARAMETERS and not is_valid_name(name):
+        raise MyshSyntaxError(f"invalid characters for variable {name}")
+    return part
+
+
+def _default_parts(text, quoted):
+    """
+    Compiles the default of ${NAME:-default} into word parts of its own, so the
+    expansions in it are only looked up when the default is used. Quotes in it
+    are removed as the tokenizer removes them; quoted is set inside "...".
+    """
+    parts = []
+    buf = []
+    buf_quoted = quoted
     i = 0
-    while i < len(cmd_str):
-        char = cmd_str[i]
+    n = len(text)
+    while i < n:
+        char = text[i]
+        if char == "'" and not quoted:
+            end = text.find("'", i + 1)
+            if end == -1:
+                raise MyshSyntaxError("unterminated quote")
+            if buf and not buf_quoted:
+                parts.append((LITERAL, ''.join(buf), buf_quoted))
+                buf = []
+            buf.append(text[i + 1:end])
+            buf_quoted = True
+            i = end + 1
+            continue
+
+        if char == '"':
+            if buf and not buf_quoted:
+                parts.append((LITERAL, ''.join(buf), buf_quoted))
+                buf = []
+            buf_quoted = True
+            i += 1
+            while True:
+                if i >= n:
+                    raise MyshSyntaxError("unterminated quote")
+                char = text[i]
+                if char == '"':
+                    break
+                if char == '\\' and i + 1 < n and text[i + 1] in _DQUOTE_ESCAPES:
+                    buf.append(text[i + 1])
+                    i += 2
+                elif char == '$':
+                    i = _scan_dollar(text, i, parts, buf, True)
+                    buf = []
+                else:
+                    buf.append(char)
+                    i += 1
+            i += 1
+            continue
 
-        if escaped:
-            result.append(char)
-            escaped = False
+        if char == '\\' and i + 1 < n and (not quoted or text[i + 1] in _DQUOTE_ESCAPES + '}'):
+            if buf and not buf_quoted:
+                parts.append((LITERAL, ''.join(buf), buf_quoted))
+                buf = []
+            buf.append(text[i + 1])
+            buf_quoted = True
+            i += 2
+            continue
 
-        elif char == '\\':
-            escaped = True
+        if buf and buf_quoted != quoted:
+            parts.append((LITERAL, ''.join(buf), buf_quoted))
+            buf = []
+        buf_quoted = quoted
+        if char == '$':
+            i = _scan_dollar(text, i, parts, buf, quoted)
+            buf = []
+        else:
+            buf.append(char)
+            i += 1
+    if buf:
+        parts.append((LITERAL, ''.join(buf), buf_quoted))
+    return tuple(parts)
 
-        elif char == "'":
-            in_single_quote = not in_single_quote
-            result.append(char)
 
+def _brace_end(line, i, quoted):
+    """
+    Returns the index of the } closing a ${ whose body starts at line[i], skipping
+    escaped characters, quoted text (single quotes only outside "...") and nested
+    ${...} and $(...), or -1 when it is never closed.
+    """
+    depth = 1
+    n = len(line)
+    while i < n:
+        char = line[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == "'" and not quoted:
+            end = line.find("'", i + 1)
+            if end == -1:
+                return -1
+            i = end + 1
+            continue
+        if char == '"':
+            i += 1
+            while i < n and line[i] != '"':
+                i += 2 if line[i] == '\\' else 1
+            if i >= n:
+                return -1
+            i += 1
+            continue
+        if line.startswith('${', i):
+            depth += 1
+            i += 2
+            continue
+        if line.startswith('$(', i):
+            end = _substitution_end(line, i + 2)
+            if end is None:
+                return -1
+            i = end
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return -1
+
+
+def _scan_dollar(line, i, parts, buf, quoted):
+    """
+    Handles a '$' at line[i], flushing buf into parts. Returns the index after the expansion.
+    """
+    following = line[i + 1:i + 2]
+    if following == '(':
+        end = _substitution_end(line, i + 2)
+        if end is None:
+            raise MyshSyntaxError("unterminated command substitution")
+        command = line[i + 2:end]
+        # syntax errors inside are reported with the line, and the parse is cached for the run
+        parse_line(command)
+        if buf:
+            parts.append((LITERAL, ''.join(buf), quoted))
+        parts.append((COMMAND, command, quoted))
+        return end + 1
+    if following in ('?', '!') and following:
+        if buf:
+            parts.append((LITERAL, ''.join(buf), quoted))
+        parts.append((VARIABLE, following, quoted))
+        return i + 2
+    if following == '{':
+        end = _brace_end(line, i + 2, quoted)
+        if end != -1:
+            part = _braced_part(line[i + 2:end], quoted)
+            if buf:
+                parts.append((LITERAL, ''.join(buf), quoted))
+            parts.append(part)
+            return end + 1
+    elif following and not following.isdigit() and _is_name_char(following):
+        end = i + 2
+        while end < len(line) and _is_name_char(line[end]):
+            end += 1
+        if buf:
+            parts.append((LITERAL, ''.join(buf), quoted))
+        parts.append((VARIABLE, line[i + 1:end], quoted))
+        return end
+    buf.append('$')
+    if buf:
+        parts.append((LITERAL, ''.join(buf), quoted))
+    return i + 1
+
+
+def _substitution_end(line, i):
+    """
+    Returns the index of the ) closing a $( whose command starts at line[i], skipping
+    quoted text and nested parentheses, or None when it is never closed.
+    """
+    depth = 1
+    n = len(line)
+    while i < n:
+        char = line[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == "'":
+            end = line.find("'", i + 1)
+            if end == -1:
+                return None
+            i = end
         elif char == '"':
-            in_double_quote = not in_double_quote
-            result.append(char)
-
-        elif char == '$' and i + 1 < len(cmd_str) and cmd_str[i + 1] == '{':
-            end_brace_index = cmd_str.find('}', i + 2)
-            if end_brace_index != -1:
-                var_name = cmd_str[i+2:end_brace_index]
-                if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', var_name):
-                    print(f"mysh: syntax error: invalid characters for variable {var_name}", file=sys.stderr)
-                    return None
-                var_value = os.environ.get(var_name, '')
-                result.append(var_value)
-                i = end_brace_index
-            else:
-                result.append(char)
-        
+            i += 1
+            while i < n and line[i] != '"':
+                i += 2 if line[i] == '\\' else 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return None
+
+
+def parse_line(line: str) -> Pipeline:
+    """
+    Cached tokenize(), so lines repeated by loops and scripts are only lexed once.
+
+    The cache keeps the PARSE_CACHE_SIZE most recently used lines.
+    """
+    pipeline = _parse_cache.pop(line, None)
+    if pipeline is None:
+        pipeline = tokenize(line)
+        if len(_parse_cache) >= PARSE_CACHE_SIZE:
+            del _parse_cache[next(iter(_parse_cache))]
+    _parse_cache[line] = pipeline
+    return pipeline
+
+
+def lookup_variable(name):
+    value = SPECIAL_PARAMETERS.get(name)
+    return get_variable(name) if value is None else value
+
+
+def set_substitution_runner(runner):
+    """
+    Sets how $(...) commands are run: runner(commands) runs a list of command
+    texts and returns {command: output}.
+    """
+    global _substitution_runner
+    _substitution_runner = runner
+
+
+def install_substitutions(outputs):
+    """
+    Makes $(...) parts render as outputs ({command: output}) gives them, returning
+    the outputs installed before, which the caller puts back once it has expanded.
+    """
+    global _substitution_outputs
+    previous = _substitution_outputs
+    _substitution_outputs = outputs
+    return previous
+
+
+def _substitution(command):
+    output = _substitution_outputs.get(command)
+    if output is None:
+        output = _substitution_runner([command])[command]
+    return output
+
+
+def _default(value):
+    return lookup_variable(value[0]) or render(value[1])
+
+
+def _length(name):
+    return str(len(lookup_variable(name)))
+
+
+_EXPANDERS = {
+    VARIABLE: lookup_variable,
+    DEFAULT: _default,
+    LENGTH: _length,
+    TILDE: os.path.expanduser,
+    COMMAND: _substitution,
+}
+
+
+def render(parts) -> str:
+    """
+    Renders compiled word parts with a single join, looking up only the expansion sites.
+    """
+    return ''.join([value if kind == LITERAL else _EXPANDERS[kind](value) for kind, value, _ in parts])
+
+
+def expand_word(word: Word) -> str:
+    """
+    Substitutes the expansion sites of a parsed word with their current values.
+    """
+    if word.literal is not None:
+        return word.literal
+    return render(word.parts)
+
+
+def pipeline_variables(pipeline: Pipeline) -> set[str]:
+    """
+    Returns the names of every variable the words and redirects of a pipeline, and of
+    the rest of its list, refer to.
+    """
+    names = set()
+    for stage in (stage for member in list_pipelines(pipeline) for stage in member.stages):
+        words = list(stage.words)
+        words.extend(target for _, op, target in stage.redirects if op != DUPLICATE)
+        for word in words:
+            _part_variables(word.parts, names)
+    return names
+
+
+def _part_variables(parts, names):
+    for kind, value, _ in parts:
+        if kind == VARIABLE or kind == LENGTH:
+            names.add(value)
+        elif kind == DEFAULT:
+            names.add(value[0])
+            _part_variables(value[1], names)
+
+
+def _escape_glob(text):
+    if _GLOB_CHARS.isdisjoint(text) and '\\' not in text:
+        return text
+    return ''.join('\\' + char if char in '*?[\\' else char for char in text)
+
+
+def _glob_pattern(word):
+    """
+    Renders a word as a pattern in which only its unquoted *, ? and [ are wildcards;
+    quoted text and expanded values are backslash-escaped.
+    """
+    pieces = []
+    for kind, value, quoted in word.parts:
+        if kind == LITERAL:
+            pieces.append(_escape_glob(value) if quoted else value)
+        else:
+            pieces.append(_escape_glob(_EXPANDERS[kind](value)))
+    return ''.join(pieces)
+
+
+def _bracket_end(component, i):
+    """
+    Returns the index of the ] closing the bracket expression that starts at
+    component[i], just after its [, or None when it is never closed.
+    """
+    n = len(component)
+    if i < n and component[i] in '!^':
+        i += 1
+    if i < n and component[i] == ']':
+        i += 1
+    while i < n and component[i] != ']':
+        i += 2 if component[i] == '\\' else 1
+    return i if i < n else None
+
+
+def _bracket_regex(body):
+    import re
+    negate = body[:1] in ('!', '^')
+    if negate:
+        body = body[1:]
+    chars = []
+    i = 0
+    while i < len(body):
+        char = body[i]
+        if char == '\\' and i + 1 < len(body):
+            i += 1
+            chars.append(re.escape(body[i]) if body[i] != '-' else '\\-')
         else:
-            result.append(char)
+            chars.append(char if char == '-' else re.escape(char))
         i += 1
+    return '[' + ('^' if negate else '') + ''.join(chars) + ']'
+
+
+def _compile_component(component):
+    """
+    Compiles one path component of a pattern, or returns the name with its escapes
+    removed when it has no wildcards. A compiled component is a pair: a multiline
+    regex that finds every matching name in a newline-separated listing at once,
+    and a match function for single names. Results are cached.
+    """
+    matcher = _matcher_cache.get(component)
+    if matcher is not None:
+        return matcher
+    import re
+    regex = []
+    literal = []
+    wild = False
+    i = 0
+    n = len(component)
+    while i < n:
+        char = component[i]
+        i += 1
+        if char == '\\' and i < n:
+            char = component[i]
+            i += 1
+        elif char == '*':
+            wild = True
+            regex.append('.*')
+            continue
+        elif char == '?':
+            wild = True
+            regex.append('.')
+            continue
+        elif char == '[':
+            end = _bracket_end(component, i)
+            if end is not None:
+                wild = True
+                regex.append(_bracket_regex(component[i:end]))
+                i = end + 1
+                continue
+        regex.append(re.escape(char))
+        literal.append(char)
+    if wild:
+        # names starting with a dot only match a component that starts with one
+        hidden = component.startswith(('.', '\\.'))
+        source = ('' if hidden else r'(?!\.)') + ''.join(regex)
+        matcher = (re.compile(f'^(?:{source})$', re.MULTILINE),
+                   re.compile(source + r'\Z', re.DOTALL).match)
+    else:
+        matcher = ''.join(literal)
+    if len(_matcher_cache) >= PARSE_CACHE_SIZE:
+        _matcher_cache.clear()
+    _matcher_cache[component] = matcher
+    return matcher
+
+
+def _list_directory(path):
+    """
+    Returns the names in a directory ('' is the current one) as one sorted,
+    newline-separated string, plus the few names that contain a newline
+    themselves. Each directory is listed only once per line; unreadable ones
+    have no entries.
+    """
+    listing = _listing_cache.get(path)
+    if listing is None:
+        try:
+            names = os.listdir(path or '.')
+        except OSError:
+            names = []
+        # sorted once here, so sorting the matches afterwards finds them in order already
+        names.sort()
+        text = '\n'.join(names)
+        odd = []
+        if names and text.count('\n') != len(names) - 1:
+            odd = [name for name in names if '\n' in name]
+            text = '\n'.join(name for name in names if '\n' not in name)
+        listing = (text, odd)
+        _listing_cache[path] = listing
+    return listing
+
+
+def _list_subdirectories(path):
+    """
+    Returns the sorted names of the directories in a directory, listed once per line.
+    os.scandir gets the file types from the listing, so no file is stat()ed.
+    """
+    directories = _subdirectory_cache.get(path)
+    if directories is None:
+        try:
+            with os.scandir(path or '.') as scan:
+                directories = sorted(entry.name for entry in scan if entry.is_dir())
+        except OSError:
+            directories = []
+        _subdirectory_cache[path] = directories
+    return directories
+
+
+def clear_glob_cache():
+    """
+    Forgets the directory listings; called once a pipeline has run so the next one sees changes.
+    """
+    _listing_cache.clear()
+    _subdirectory_cache.clear()
+
+
+def _join(directory, name):
+    if not directory:
+        return name
+    return directory + name if directory.endswith('/') else directory + '/' + name
+
+
+def _match_directory(path, matcher, want_dirs):
+    """
+    Returns the names in a directory matching a compiled component, only
+    subdirectories when want_dirs is set.
+    """
+    find_all, match = matcher
+    if want_dirs:
+        return [name for name in _list_subdirectories(path) if match(name)]
+    text, odd = _list_directory(path)
+    names = find_all.findall(text) if text else []
+    names.extend(name for name in odd if match(name))
+    return names
 
-    expanded_cmd_str = ''.join(result)
-    return expanded_cmd_str.replace('~', '/home', 1)
 
-    
-def handle_syntax_errors(cmd_str: str) -> bool:
+def glob_pattern(pattern: str) -> list[str]:
     """
-    Checks for syntax errors in the command string, specifically handling nested quotes.
+    Returns the sorted paths matching pattern, where *, ? and [...] match within one
+    path component and backslash quotes the next character. Names starting with
+    a dot are only matched by a component that starts with one.
     """
-    in_single_quote = False
-    in_double_quote = False
+    components = pattern.split('/')
+    paths = ['']
+    if pattern.startswith('/'):
+        paths = ['/']
+        components = components[1:]
+    unchecked = False
+    last = len(components) - 1
+    for index, component in enumerate(components):
+        if not component:
+            if index == last:
+                paths = [path + '/' for path in paths]
+            continue
+        matcher = _compile_component(component)
+        if isinstance(matcher, str):
+            paths = [_join(path, matcher) for path in paths]
+            unchecked = True
+            continue
+        matched = []
+        for path in paths:
+            names = _match_directory(path, matcher, index != last)
+            if not path:
+                matched.extend(names)
+            else:
+                prefix = path if path.endswith('/') else path + '/'
+                matched.extend([prefix + name for name in names])
+        paths = matched
+        unchecked = False
+        if not paths:
+            return []
+    if unchecked:
+        paths = [path for path in paths if os.path.lexists(path)]
+    paths.sort()
+    return paths
+
+
+def expand_glob(word: Word) -> list[str]:
+    """
+    Expands a pattern word into the paths it matches, or the word itself when there are none.
+    """
+    return glob_pattern(_glob_pattern(word)) or [expand_word(word)]
+
+
+def expand_stage(stage: Stage) -> list[str]:
+    if not stage.glob:
+        return [expand_word(word) for word in stage.words]
+    args = []
+    for word in stage.words:
+        if word.glob:
+            args.extend(expand_glob(word))
+        else:
+            args.append(expand_word(word))
+    return args
+
 
-    for char in cmd_str:
-        if char == "'" and not in_double_quote:
-            in_single_quote = not in_single_quote
-        elif char == '"' and not in_single_quote:
-            in_double_quote = not in_double_quote
+def expand_stage_fields(stage: Stage) -> list[list[str]]:
+    """
+    Like expand_stage(), but keeps the arguments each word expanded into together.
+    """
+    return [expand_glob(word) if word.glob else [expand_word(word)] for word in stage.words]
 
-    if in_single_quote or in_double_quote:
-        print("mysh: syntax error: unterminated quote", file=sys.stderr)
-        return True
-    
-    return False
+
+def expand_redirects(stage: Stage) -> list[tuple]:
+    """
+    Returns the stage's redirects with every file name expanded.
+    """
+    return [(fd, op, target if op == DUPLICATE else expand_word(target))
+            for fd, op, target in stage.redirects]
 
 
+def split_by_pipe_op(cmd_str: str) -> list[str]:
+    """
+    Splits the command string by unquoted pipe operators.
+    """
+    return [stage.text for stage in parse_line(cmd_str).stages]
+
+def _read_rc_cache(key):
+    try:
+        with open(cache_path("myshrc.cache"), "rb") as f:
+            cached_key, result = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return result if cached_key == key else None
+
+
+def _write_rc_cache(key, result):
+    try:
+        write_atomically(cache_path("myshrc.cache"), marshal.dumps((key, result)))
+    except OSError:
+        pass
+
+
+def _validate_myshrc(myshrc_path):
+    """
+    Reads and checks the .myshrc file. Returns the (name, value, needs_expansion)
+    entries to set and the error messages to report.
+    """
+    import json
+    entries = []
+    messages = []
+    try:
+        with open(myshrc_path, "r") as f:
+            data = json.load(f)
+    except json.JSONDecodeError:
+        messages.append("mysh: invalid JSON format for .myshrc")
+        return entries, messages
+
+    for key, value in data.items():
+        if not is_valid_name(key):
+            messages.append(f"mysh: .myshrc: {key}: invalid characters for variable name")
+        elif not isinstance(value, str):
+            messages.append(f"mysh: .myshrc: {key}: not a string")
+        else:
+            entries.append((key, value, '$' in value))
+    return entries, messages
+
+
+def parse_myshrc(env_vars):
+    """
+    Parses the .myshrc file to set environment variables.
+
+    The validated contents are cached by path, mtime and size, so unchanged
+    files are loaded with one read. Returns "cache", "parsed" or "missing".
+    """
+    myshrc_path = os.path.expanduser("~/.myshrc")
+    if os.getenv("MYSHDOTDIR"):
+        myshrc_path = os.path.join(os.getenv("MYSHDOTDIR"), ".myshrc")
+
+    source = "missing"
+    try:
+        st = os.stat(myshrc_path)
+    except OSError:
+        st = None
+
+    if st is not None:
+        key = (RC_CACHE_FORMAT, myshrc_path, st.st_mtime_ns, st.st_size)
+        result = _read_rc_cache(key)
+        source = "cache"
+        if result is None:
+            result = _validate_myshrc(myshrc_path)
+            _write_rc_cache(key, result)
+            source = "parsed"
+        entries, messages = result
+        for message in messages:
+            print(message, file=sys.stderr)
+        for name, value, needs_expansion in entries:
+            if needs_expansion:
+                value = os.path.expandvars(value)
+            set_variable(name, value, export=True)
+            env_vars[name] = value
+
+    if "PROMPT" not in os.environ:
+        set_variable("PROMPT", ">> ", export=True)
+    if "MYSH_VERSION" not in os.environ:
+        set_variable("MYSH_VERSION", "1.0", export=True)
+    if "PATH" not in os.environ:
+        set_variable("PATH", os.defpath, export=True)
+    return source
+
+def compile_template(text: str) -> tuple:
+    """
+    Compiles text into word parts, with backslash escapes and $ expansions but no
+    quote removal or word splitting. Templates are cached by text.
+    """
+    parts = _template_cache.get(text)
+    if parts is not None:
+        return parts
+    parts = []
+    buf = []
+    i = 0
+    n = len(text)
+    while i < n:
+        next_special = i
+        while next_special < n and text[next_special] not in '$\\':
+            next_special += 1
+        if next_special > i:
+            buf.append(text[i:next_special])
+            i = next_special
+            continue
+        if text[i] == '\\' and i + 1 < n:
+            buf.append(text[i + 1])
+            i += 2
+            continue
+        if text[i] == '$':
+            i = _scan_dollar(text, i, parts, buf, False)
+            buf = []
+            continue
+        buf.append(text[i])
+        i += 1
+    if buf:
+        parts.append((LITERAL, ''.join(buf), False))
+    parts = tuple(parts)
+    if len(_template_cache) >= PARSE_CACHE_SIZE:
+        _template_cache.clear()
+    _template_cache[text] = parts
+    return parts
+
+
+def expand_variables(cmd_str: str) -> str:
+    """
+    Expands $NAME, ${NAME}, ${NAME:-default}, ${#NAME}, $? and $(command) in a
+    string, running all the commands at once. Returns None after reporting a
+    syntax error.
+    """
+    try:
+        parts = compile_template(cmd_str)
+    except MyshSyntaxError as e:
+        print(f"mysh: syntax error: {e}", file=sys.stderr)
+        return None
+    commands = list(dict.fromkeys(value for kind, value, _ in parts if kind == COMMAND))
+    if not commands:
+        return render(parts)
+    previous = install_substitutions(_substitution_runner(commands))
+    try:
+        return render(parts)
+    finally:
+        install_substitutions(previous)
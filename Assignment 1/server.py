@@ -0,0 +1,157 @@
+import os
+import sys
+import marshal
+import socket
+import signal
+
+SERVER_BACKLOG = 128
+REPLY_SIZE = 64
+
+
+class ServerError(Exception):
+    pass
+
+
+def _pack_fds(fds):
+    return b''.join(fd.to_bytes(4, sys.byteorder) for fd in fds)
+
+
+def _unpack_fds(data):
+    return [int.from_bytes(data[i:i + 4], sys.byteorder) for i in range(0, len(data) - 3, 4)]
+
+
+def connect(path, request):
+    """
+    Sends request to the server at path along with this process's stdin, stdout and
+    stderr, and waits for the session's exit status. Raises ServerError or OSError.
+
+    The worker writes straight to the passed fds, so output is never relayed
+    through the socket; only the exit status comes back on it.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        payload = marshal.dumps(request)
+        message = len(payload).to_bytes(4, 'big') + payload
+        sent = sock.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, _pack_fds([0, 1, 2]))])
+        if sent < len(message):
+            sock.sendall(message[sent:])
+        reply = b''
+        while True:
+            data = sock.recv(REPLY_SIZE)
+            if not data:
+                break
+            reply += data
+    finally:
+        sock.close()
+    try:
+        return int(reply)
+    except ValueError:
+        raise ServerError("server closed the connection without a status")
+
+
+def _receive_request(conn):
+    """
+    Reads one request and the three fds sent with it from a client connection.
+    """
+    fd_space = socket.CMSG_SPACE(3 * 4)
+    data, ancdata, _, _ = conn.recvmsg(1 << 16, fd_space)
+    fds = []
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.extend(_unpack_fds(cmsg_data))
+    while len(data) < 4 or len(data) < 4 + int.from_bytes(data[:4], 'big'):
+        more = conn.recv(1 << 16)
+        if not more:
+            break
+        data += more
+    if len(fds) != 3 or len(data) < 4:
+        for fd in fds:
+            os.close(fd)
+        raise ServerError("malformed request")
+    return marshal.loads(data[4:4 + int.from_bytes(data[:4], 'big')]), fds
+
+
+def _worker(listener, run_session):
+    """
+    Body of a pre-forked worker: serves exactly one client and exits, so no state
+    from one session (cwd, variables, jobs) can reach the next.
+    """
+    status = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        conn, _ = listener.accept()
+        listener.close()
+        try:
+            request, fds = _receive_request(conn)
+            try:
+                status = run_session(request, fds)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall(str(status).encode())
+        finally:
+            conn.close()
+    except BaseException as e:
+        print(f"mysh: server worker: {e}", file=sys.stderr)
+    finally:
+        os._exit(status & 0xff)
+
+
+def _start_worker(listener, run_session):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        _worker(listener, run_session)
+    return pid
+
+
+def _stop(signum, frame):
+    raise SystemExit(0)
+
+
+def serve(path, run_session, workers):
+    """
+    Listens on a Unix socket at path, keeping workers forked copies of this (already
+    warmed up) shell waiting to accept a client. Each finished worker is replaced.
+
+    run_session(request, fds) runs one client's session in a worker and returns
+    its exit status. Runs until SIGTERM or SIGINT.
+    """
+    import stat
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise ServerError(f"{path}: exists and is not a socket")
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user running the server may connect
+    old_umask = os.umask(0o077)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(old_umask)
+    listener.listen(SERVER_BACKLOG)
+
+    pool = set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    try:
+        while True:
+            while len(pool) < workers:
+                pool.add(_start_worker(listener, run_session))
+            pid, _ = os.wait()
+            pool.discard(pid)
+    finally:
+        for pid in pool:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        listener.close()
+        os.unlink(path)
@@ -0,0 +1,88 @@
+import os
+import errno
+import stat
+
+TEE_CHUNK_SIZE = 1 << 20
+COPY_CHUNK_SIZE = 1 << 16
+
+_libc_tee = None
+
+
+def _tee_call():
+    """
+    Returns tee(2) through ctypes (os has no wrapper for it), or None where it is unavailable.
+    """
+    global _libc_tee
+    if _libc_tee is None:
+        try:
+            import ctypes
+            tee = ctypes.CDLL(None, use_errno=True).tee
+            tee.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+            tee.restype = ctypes.c_ssize_t
+            _libc_tee = (tee, ctypes.get_errno)
+        except (ImportError, OSError, AttributeError):
+            _libc_tee = False
+    return _libc_tee or None
+
+
+def _is_pipe(fd):
+    try:
+        return stat.S_ISFIFO(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_stream(source, sink, files):
+    while True:
+        data = os.read(source, COPY_CHUNK_SIZE)
+        if not data:
+            return
+        _write_all(sink, data)
+        for fd in files:
+            _write_all(fd, data)
+
+
+def _splice_all(source, target, count):
+    while count:
+        moved = os.splice(source, target, count)
+        if moved == 0:
+            raise OSError(errno.EIO, "unexpected end of input")
+        count -= moved
+
+
+def tee_stream(source, sink, files):
+    """
+    Copies everything from source to sink and to each fd in files, until EOF.
+
+    When source and sink are pipes and there is at most one file, the bytes
+    never enter Python: tee(2) duplicates them from source into sink, and
+    splice(2) then moves the same bytes from source into the file. Otherwise
+    they are copied through os.read/os.write.
+    """
+    tee = None
+    if len(files) <= 1 and hasattr(os, 'splice') and _is_pipe(source) and _is_pipe(sink):
+        tee = _tee_call()
+    if tee is None:
+        return _copy_stream(source, sink, files)
+
+    tee, get_errno = tee
+    if not files:
+        while os.splice(source, sink, TEE_CHUNK_SIZE):
+            pass
+        return
+    while True:
+        count = tee(source, sink, TEE_CHUNK_SIZE, 0)
+        if count < 0:
+            error = get_errno()
+            if error == errno.EINTR:
+                continue
+            raise OSError(error, os.strerror(error))
+        if count == 0:
+            return
+        _splice_all(source, files[0], count)
@@ -0,0 +1,119 @@
+"""
+Runs the io_files cases inside a single interpreter instead of one mysh.py per case.
+
+Usage: python3 tests/run_tests.py [--json] [--root DIR] [case ...]
+
+Each case is fed to mysh.run_batch() with the working directory set to this
+tests directory and with fds 1 and 2 pointed at a temporary file, so builtins
+and child processes are both captured. Paths under the directory holding
+mysh.py are reported as if it were --root (default /home), which is where the
+expected files assume the shell lives. --json prints the results as JSON.
+"""
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+IO_DIR = os.path.join(TESTS_DIR, 'io_files')
+SHELL_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, SHELL_DIR)
+
+import mysh
+from parsing import parse_myshrc, SPECIAL_PARAMETERS
+from variables import clear_shell_variables
+
+_LS_DATE_PATTERN = re.compile(r'[ ]+[A-Z][a-z]{2}[ ]+[0-9]{1,2}[ ]+[0-9]{2}:[0-9]{2}')
+
+
+def run_case(name, root):
+    with open(os.path.join(IO_DIR, name + '.in')) as f:
+        lines = f.readlines()
+    with open(os.path.join(IO_DIR, name + '.expected')) as f:
+        expected = f.read()
+
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+    os.chdir(TESTS_DIR)
+    os.environ['PWD'] = TESTS_DIR
+    clear_shell_variables()
+    SPECIAL_PARAMETERS.update({'?': '0', 'PIPESTATUS': '0'})
+
+    with tempfile.TemporaryFile() as out:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = os.dup(1), os.dup(2)
+        os.dup2(out.fileno(), 1)
+        os.dup2(out.fileno(), 2)
+        start = time.perf_counter()
+        try:
+            mysh.run_batch(lines)
+        except SystemExit:
+            pass
+        finally:
+            elapsed = time.perf_counter() - start
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            os.chdir(saved_cwd)
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            clear_shell_variables()
+        out.seek(0)
+        output = out.read().decode(errors='replace')
+
+    output = _LS_DATE_PATTERN.sub('', output).replace(SHELL_DIR, root)
+    return {
+        "name": name,
+        "passed": output.rstrip('\n') == expected.rstrip('\n'),
+        "seconds": elapsed,
+        "expected": expected,
+        "got": output,
+    }
+
+
+def main():
+    args = sys.argv[1:]
+    as_json = False
+    root = '/home'
+    names = []
+    i = 0
+    while i < len(args):
+        if args[i] == '--json':
+            as_json = True
+        elif args[i] == '--root' and i + 1 < len(args):
+            root = args[i + 1]
+            i += 1
+        else:
+            names.append(args[i])
+        i += 1
+    if not names:
+        names = sorted(f[:-3] for f in os.listdir(IO_DIR) if f.endswith('.in'))
+
+    parse_myshrc({})
+    results = [run_case(name, root) for name in names]
+    passed = sum(result["passed"] for result in results)
+
+    if as_json:
+        print(json.dumps({"passed": passed, "failed": len(results) - passed, "cases": results}, indent=2))
+    else:
+        for result in results:
+            if result["passed"]:
+                print(f"{result['name']}: PASSED ({result['seconds'] * 1e3:.1f} ms)")
+            else:
+                print(f"{result['name']}: FAILED")
+                print("Expected:")
+                print(result["expected"], end='')
+                print("Got:")
+                print(result["got"], end='')
+        print(f"Passed {passed} out of {len(results)} tests.")
+    sys.exit(0 if passed == len(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -53,6 +53,26 @@ run_test "Test multiple_commands" "$TEST_DIR/multiple_commands.in" "$TEST_DIR/mu
 run_test "Test variable_expansion" "$TEST_DIR/variable_expansion.in" "$TEST_DIR/variable_expansion.expected"
 run_test "Test mkdir_rmdir_command" "$TEST_DIR/mkdir_rmdir_command.in" "$TEST_DIR/mkdir_rmdir_command.expected"
 run_test "Test chmod_command" "$TEST_DIR/chmod_command.in" "$TEST_DIR/chmod_command.expected"
+run_test "Test hash_command" "$TEST_DIR/hash_command.in" "$TEST_DIR/hash_command.expected"
+run_test "Test syntax_errors" "$TEST_DIR/syntax_errors.in" "$TEST_DIR/syntax_errors.expected"
+run_test "Test var_capture" "$TEST_DIR/var_capture.in" "$TEST_DIR/var_capture.expected"
+run_test "Test exit_status" "$TEST_DIR/exit_status.in" "$TEST_DIR/exit_status.expected"
+run_test "Test builtin_pipeline" "$TEST_DIR/builtin_pipeline.in" "$TEST_DIR/builtin_pipeline.expected"
+run_test "Test background_jobs" "$TEST_DIR/background_jobs.in" "$TEST_DIR/background_jobs.expected"
+run_test "Test parallel_command" "$TEST_DIR/parallel_command.in" "$TEST_DIR/parallel_command.expected"
+run_test "Test export_command" "$TEST_DIR/export_command.in" "$TEST_DIR/export_command.expected"
+run_test "Test times_command" "$TEST_DIR/times_command.in" "$TEST_DIR/times_command.expected"
+run_test "Test redirection" "$TEST_DIR/redirection.in" "$TEST_DIR/redirection.expected"
+run_test "Test parameter_expansion" "$TEST_DIR/parameter_expansion.in" "$TEST_DIR/parameter_expansion.expected"
+run_test "Test server_mode" "$TEST_DIR/server_mode.in" "$TEST_DIR/server_mode.expected"
+run_test "Test cache_command" "$TEST_DIR/cache_command.in" "$TEST_DIR/cache_command.expected"
+run_test "Test history_command" "$TEST_DIR/history_command.in" "$TEST_DIR/history_command.expected"
+run_test "Test tee_command" "$TEST_DIR/tee_command.in" "$TEST_DIR/tee_command.expected"
+run_test "Test glob_expansion" "$TEST_DIR/glob_expansion.in" "$TEST_DIR/glob_expansion.expected"
+run_test "Test command_substitution" "$TEST_DIR/command_substitution.in" "$TEST_DIR/command_substitution.expected"
+run_test "Test timeout_limit" "$TEST_DIR/timeout_limit.in" "$TEST_DIR/timeout_limit.expected"
+run_test "Test command_lists" "$TEST_DIR/command_lists.in" "$TEST_DIR/command_lists.expected"
+run_test "Test comments" "$TEST_DIR/comments.in" "$TEST_DIR/comments.expected"
 echo "Passed $passed_tests out of $total_tests tests."
 echo "Failed $failed_tests out of $total_tests tests."
 
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+
+# Set by start_trace(). Everything else here is only called when it is set,
+# so with tracing off the shell pays for one attribute check per command.
+enabled = False
+_trace_file = None
+
+# Session totals for the times builtin. The counters are always kept; the
+# phase totals only while tracing.
+counters = {"lines": 0, "pipelines": 0, "processes": 0, "builtins": 0}
+phase_totals = {}
+
+
+def start_trace(path):
+    """
+    Appends a JSON record per command line and per pipeline to path, or to stderr for '-'.
+    """
+    global enabled, _trace_file
+    if path == '-':
+        _trace_file = os.fdopen(os.dup(2), 'w', buffering=1)
+    else:
+        _trace_file = open(path, 'a', buffering=1)
+    enabled = True
+
+
+def start(kind, command):
+    now = time.perf_counter()
+    return {"type": kind, "time": time.time(), "command": command, "_began": now, "_last": now}
+
+
+def mark(record, phase):
+    """
+    Stores the time since the previous mark (or start) as the phase's duration in microseconds.
+    """
+    now = time.perf_counter()
+    record[phase + "_us"] = round((now - record["_last"]) * 1e6, 1)
+    record["_last"] = now
+
+
+def child_usage(pid, command, status, usage):
+    """
+    Describes one reaped child from its wait4() rusage. ru_maxrss is in kilobytes on Linux.
+    """
+    entry = {"pid": pid, "command": command, "status": status}
+    if usage is not None:
+        entry.update({
+            "user_s": round(usage.ru_utime, 6),
+            "sys_s": round(usage.ru_stime, 6),
+            "maxrss_kb": usage.ru_maxrss,
+            "voluntary_switches": usage.ru_nvcsw,
+            "involuntary_switches": usage.ru_nivcsw,
+        })
+    return entry
+
+
+def finish(record, status):
+    import json
+    del record["_last"]
+    for key, value in record.items():
+        if key.endswith("_us"):
+            phase_totals[key[:-3]] = phase_totals.get(key[:-3], 0.0) + value
+    record["total_us"] = round((time.perf_counter() - record.pop("_began")) * 1e6, 1)
+    record["status"] = status
+    try:
+        _trace_file.write(json.dumps(record) + "\n")
+    except (OSError, ValueError) as e:
+        print(f"mysh: trace: {e}", file=sys.stderr)
+
+
+def _format_seconds(seconds):
+    return f"{int(seconds // 60)}m{seconds % 60:.3f}s"
+
+
+def report_times(verbose=False):
+    """
+    Prints the user and system time of the shell and of its children, as times(1) does.
+
+    verbose adds the session counters, the children's peak memory and context
+    switches, and the time spent in each phase if tracing is on.
+    """
+    shell_times = os.times()
+    print(f"{_format_seconds(shell_times.user)} {_format_seconds(shell_times.system)}")
+    print(f"{_format_seconds(shell_times.children_user)} {_format_seconds(shell_times.children_system)}")
+    if not verbose:
+        return
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    for name, value in counters.items():
+        print(f"{name}: {value}")
+    print(f"children max rss: {usage.ru_maxrss} kB")
+    print(f"children context switches: {usage.ru_nvcsw} voluntary, {usage.ru_nivcsw} involuntary")
+    for phase, micros in phase_totals.items():
+        print(f"{phase}: {micros / 1e3:.3f} ms")
@@ -0,0 +1,70 @@
+import os
+
+# Variables set with var that were never exported. Children never see them.
+_shell_variables = {}
+
+# The bytes environment handed to posix_spawn/execve, and a plain dict copy of
+# os.environ for lookups (os.environ encodes and decodes on every access).
+# None means they have to be rebuilt because an exported variable changed.
+_child_environ = None
+_environ_values = None
+
+
+def get_variable(name, default=''):
+    global _environ_values
+    value = _shell_variables.get(name)
+    if value is not None:
+        return value
+    if _environ_values is None:
+        _environ_values = dict(os.environ)
+    return _environ_values.get(name, default)
+
+
+def set_variable(name, value, export=False):
+    """
+    Assigns a variable. It goes into the environment when it is exported
+    already or export is set, and stays local to the shell otherwise.
+    """
+    if export or name in os.environ:
+        _shell_variables.pop(name, None)
+        os.environ[name] = value
+        mark_environ_dirty()
+    else:
+        _shell_variables[name] = value
+
+
+def export_variable(name, value=None):
+    """
+    Moves a variable into the environment, setting it to value if one is given.
+    """
+    if value is None:
+        value = _shell_variables.get(name, os.environ.get(name, ''))
+    set_variable(name, value, export=True)
+
+
+def exported_variables():
+    return sorted(os.environ.items())
+
+
+def child_environ():
+    """
+    Returns the environment for children, already encoded, rebuilding it only after a change.
+    """
+    global _child_environ
+    if _child_environ is None:
+        _child_environ = dict(os.environb)
+    return _child_environ
+
+
+def mark_environ_dirty():
+    """
+    Must be called after os.environ is changed without set_variable().
+    """
+    global _child_environ, _environ_values
+    _child_environ = None
+    _environ_values = None
+
+
+def clear_shell_variables():
+    _shell_variables.clear()
+    mark_environ_dirty()